@@ -0,0 +1,211 @@
+"""Offline benchmark of the posting pipeline.
+
+Seeds a throwaway SQLite database with tasks and groups, swaps Telethon and
+the Bot API for the fakes in ``benchmarks.fakes`` and times scheduler ticks:
+
+    python -m benchmarks.bench_posting --tasks 100 1000 10000 --output bench.json
+
+Results are printed (or written to ``--output``) as JSON so runs on
+different commits can be compared. A tick that runs more than
+``thread_svc.MAX_QUERIES_PER_TICK`` SQL statements aborts the run.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import subprocess
+import tracemalloc
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tasks', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='numbers of active tasks to benchmark')
+    parser.add_argument('--groups-per-task', type=int, default=10)
+    parser.add_argument('--accounts', type=int, default=0,
+                        help='distinct Telegram accounts (default: tasks / 10)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each fake send_message takes')
+    parser.add_argument('--connect-latency', type=float, default=0.0,
+                        help='seconds each fake client.connect takes')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='share of fake sends that raise')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--database', default=None,
+                        help='database URI (default: a temporary SQLite file)')
+    parser.add_argument('--output', default=None,
+                        help='write JSON results here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    # Must run before config is imported: python-decouple reads os.environ.
+    database = args.database or 'sqlite:///{}'.format(
+        os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    )
+    os.environ.update({
+        'DATABASE_URI': database,
+        'TELEGRAM_TOKEN': '123456:benchmark',
+        'TELEGRAM_API_ID': '1',
+        'TELEGRAM_API_HASH': 'benchmark',
+        'LOGS_GROUP_ID': '-1',
+        'POSTING_WORKERS': str(args.workers),
+        'SEND_RATE_PER_ACCOUNT': '1000000',
+        'SEND_BURST_PER_ACCOUNT': '1000000',
+        'SCHEDULER_RESYNC_INTERVAL': '3600',
+    })
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_database():
+    import migrations
+    from database import Base, engine
+
+    Base.metadata.drop_all(engine)
+    migrations.version_table.drop(engine, checkfirst=True)
+    migrations.upgrade()
+
+
+def seed(tasks, groups_per_task, accounts):
+    from database import engine
+    from models import Token, User, TelegramSession, Task, TelegramGroup
+
+    now = datetime.datetime.now()
+    with engine.begin() as connection:
+        connection.execute(Token.__table__.insert(), [{
+            'id': 1, 'value': 'benchmark',
+            'valid_until': datetime.date.today() + datetime.timedelta(days=365),
+        }])
+        connection.execute(User.__table__.insert(), [
+            {'tg_id': i + 1, 'token_id': 1, 'is_admin': False}
+            for i in range(accounts)
+        ])
+        connection.execute(TelegramSession.__table__.insert(), [
+            {'id': i + 1, 'phone_number': '+1{:010d}'.format(i), 'active': True,
+             'user_id': i + 1, 'created_at': now}
+            for i in range(accounts)
+        ])
+        connection.execute(Task.__table__.insert(), [
+            {'id': t + 1, 'message': 'Benchmark message', 'interval': 60,
+             'active': True, 'user_id': t % accounts + 1,
+             'session_id': t % accounts + 1, 'next_run_at': now, 'created_at': now}
+            for t in range(tasks)
+        ])
+        rows = []
+        for t in range(tasks):
+            for g in range(groups_per_task):
+                rows.append({'title': 'Group {}'.format(g),
+                             'tg_id': -(t * groups_per_task + g + 1),
+                             'task_id': t + 1})
+                if len(rows) == 50000:
+                    connection.execute(TelegramGroup.__table__.insert(), rows)
+                    rows = []
+        if rows:
+            connection.execute(TelegramGroup.__table__.insert(), rows)
+
+
+def timed_tick():
+    import thread_svc
+    from database import assert_max_queries, session
+
+    started = time.perf_counter()
+    # Fails the run as soon as a tick's statements grow with the tasks.
+    with assert_max_queries(thread_svc.MAX_QUERIES_PER_TICK) as counter:
+        thread_svc.posting_messages()
+    elapsed = time.perf_counter() - started
+    session.remove()
+    return elapsed, counter.count
+
+
+def run(args, tasks, stats):
+    import thread_svc
+    from scheduler import task_scheduler
+    from delivery_log import delivery_log
+
+    accounts = args.accounts or max(1, tasks // 10)
+    reset_database()
+    seed(tasks, args.groups_per_task, accounts)
+    stats.reset()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    thread_svc.load_schedule()
+    ticks = []
+    while True:
+        ticks.append(timed_tick())
+        if not task_scheduler.running():
+            break
+        next_run_at = task_scheduler.next_run_at()
+        if thread_svc.completed_jobs.empty() and \
+                (next_run_at is None or next_run_at > datetime.datetime.now()):
+            time.sleep(0.005)
+    wall_seconds = time.perf_counter() - started
+    idle_seconds, idle_queries = timed_tick()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    delivery_log.flush()
+
+    busy_ticks = [t for t in ticks if t[1]]
+    return {
+        'tasks': tasks,
+        'groups_per_task': args.groups_per_task,
+        'accounts': accounts,
+        'ticks': len(busy_ticks),
+        'max_tick_seconds': max(t[0] for t in busy_ticks),
+        'mean_tick_seconds': sum(t[0] for t in busy_ticks) / len(busy_ticks),
+        'max_tick_queries': max(t[1] for t in busy_ticks),
+        'idle_tick_seconds': idle_seconds,
+        'idle_tick_queries': idle_queries,
+        'wall_seconds': wall_seconds,
+        'sends': stats.get('sends'),
+        'failures': stats.get('failures'),
+        'sends_per_second': stats.get('sends') / wall_seconds if wall_seconds else None,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    configure_environment(args)
+
+    import config
+    import thread_svc
+    from client_pool import pool
+    from benchmarks.fakes import FakeClientFactory, FakeBot, Stats
+
+    config.logger.setLevel('WARNING')
+    stats = Stats()
+    pool.factory = FakeClientFactory(stats=stats, latency=args.latency,
+                                     connect_latency=args.connect_latency,
+                                     failure_rate=args.failure_rate)
+    thread_svc.bot = FakeBot(stats=stats)
+    thread_svc.log_digest.bot = thread_svc.bot
+
+    report = {
+        'revision': git_revision(),
+        'created_at': datetime.datetime.now().isoformat(),
+        'parameters': vars(args),
+        'results': [run(args, tasks, stats) for tasks in args.tasks],
+    }
+    thread_svc.engine.shutdown()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+"""Load test of the bot's conversations.
+
+Replays synthetic updates from simulated users through the real
+``telegram_bot.dispatcher``, with the Bot API and Telethon replaced by the
+fakes in ``benchmarks.fakes``:
+
+    python -m benchmarks.load_test --users 1 10 50 100 --output load.json
+
+Every simulated user adds an account, creates a task with /start_posting
+and edits its groups with /my_tasks, sending each update only once the
+previous one has been handled and any "Working…" message it sent has been
+replaced with the result. Latency is measured from putting an update on
+the dispatcher's queue until its handlers have finished, so it includes
+the time spent waiting behind other users' updates; steps that finish in
+the background also report the time until their result was shown. The
+exit status is non-zero unless every simulated user completed the flow.
+"""
+import os
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+import itertools
+import threading
+
+from benchmarks.bench_posting import git_revision, reset_database
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 50, 100],
+                        help='numbers of concurrent simulated users')
+    parser.add_argument('--groups', type=int, default=20,
+                        help='groups in each fake account')
+    parser.add_argument('--telethon-latency', type=float, default=0.05,
+                        help='seconds each fake Telethon call takes')
+    parser.add_argument('--bot-latency', type=float, default=0.02,
+                        help='seconds each fake Bot API call takes')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='seconds a user waits between two updates')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='handle updates on webhook.UpdateWorkers with this '
+                             'many threads (default: the polling dispatcher)')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds to wait for an update to be handled')
+    parser.add_argument('--database', default=None,
+                        help='database URI (default: a temporary SQLite file)')
+    parser.add_argument('--output', default=None,
+                        help='write JSON results here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    # Must run before config is imported: python-decouple reads os.environ.
+    database = args.database or 'sqlite:///{}'.format(
+        os.path.join(tempfile.mkdtemp(), 'load.sqlite')
+    )
+    os.environ.update({
+        'DATABASE_URI': database,
+        'TELEGRAM_TOKEN': '123456:loadtest',
+        'TELEGRAM_API_ID': '1',
+        'TELEGRAM_API_HASH': 'loadtest',
+        'LOGS_GROUP_ID': '-1',
+        # No scheduler consumes the task events the handlers publish.
+        'RUN_SCHEDULER': 'False',
+    })
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User {}'.format(user_id)}
+
+
+def message_update(update_id, user_id, text):
+    message = {'message_id': update_id,
+               'date': int(time.time()),
+               'chat': {'id': user_id, 'type': 'private'},
+               'from': _user(user_id),
+               'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id, user_id, data):
+    return {'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': _user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {'message_id': update_id,
+                            'date': int(time.time()),
+                            'chat': {'id': user_id, 'type': 'private'},
+                            'text': 'Menu'},
+            }}
+
+
+def account_id(user_id):
+    from sqlalchemy import select
+    from database import engine
+    from models import TelegramSession
+
+    table = TelegramSession.__table__
+    return engine.execute(select([table.c.id]).where(
+        table.c.user_id == user_id
+    )).scalar()
+
+
+def scenario(user_id, user_data):
+    # A generator, so ids saved by one handler are read only after it ran.
+    yield 'add_account', message_update, '/add_account +2{:010d}'.format(user_id)
+    yield 'confirm_tg_account', message_update, '12345'
+    yield 'start_posting', message_update, '/start_posting'
+    yield 'select_account', callback_update, str(account_id(user_id))
+    yield 'message', message_update, 'Load test message'
+    yield 'interval', message_update, '60'
+    yield 'select_groups', callback_update, 'save_all'
+    yield 'start_task', callback_update, '1'
+    yield 'my_tasks', message_update, '/my_tasks'
+    yield 'select_task', callback_update, str(user_data['task_id'])
+    yield 'task_menu', callback_update, 'edit_groups'
+    yield 'edit_groups', callback_update, 'edit_save_all'
+
+
+class ErrorCounter(logging.Handler):
+
+    def __init__(self, stats):
+        super().__init__(logging.ERROR)
+        self.stats = stats
+
+    def emit(self, record):
+        self.stats.add('handler_errors')
+
+
+class Replay:
+    """Feeds updates to the dispatcher and waits until each is handled."""
+
+    def __init__(self, dispatcher, submit, timeout):
+        from telegram import Update
+        from telegram.ext import TypeHandler
+
+        self.dispatcher = dispatcher
+        self.submit = submit
+        self.timeout = timeout
+        self._update_ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Runs after the conversations (group 0) and session cleanup (group 1).
+        dispatcher.add_handler(TypeHandler(Update, self._handled), group=2)
+
+    def _handled(self, bot, update):
+        with self._lock:
+            event = self._pending.pop(update.update_id, None)
+        if event is not None:
+            event.set()
+
+    def send(self, build, user_id, payload):
+        from telegram import Update
+
+        update_id = next(self._update_ids)
+        update = Update.de_json(build(update_id, user_id, payload),
+                                self.dispatcher.bot)
+        event = threading.Event()
+        with self._lock:
+            self._pending[update_id] = event
+        started = time.perf_counter()
+        self.submit(update)
+        if not event.wait(self.timeout):
+            with self._lock:
+                self._pending.pop(update_id, None)
+            return None
+        return time.perf_counter() - started
+
+
+def seed_users(user_ids):
+    from database import engine
+    from models import Token, User
+
+    with engine.begin() as connection:
+        connection.execute(Token.__table__.insert(), [{
+            'id': 1, 'value': 'loadtest',
+            'valid_until': datetime.date.today() + datetime.timedelta(days=365),
+        }])
+        connection.execute(User.__table__.insert(), [
+            {'tg_id': user_id, 'token_id': 1, 'is_admin': False}
+            for user_id in user_ids
+        ])
+
+
+def wait_for_result(bot_request, user_id, timeout):
+    from telegram_svc import WORKING_TEXT
+
+    deadline = time.perf_counter() + timeout
+    while bot_request.last_text.get(user_id) == WORKING_TEXT:
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def simulate_user(replay, bot_request, user_id, think_time, latencies,
+                  result_latencies, stats):
+    # An exception would otherwise end the thread without a trace in the
+    # report.
+    try:
+        _simulate_user(replay, bot_request, user_id, think_time, latencies,
+                       result_latencies, stats)
+    except Exception:
+        logging.getLogger(__name__).exception('Simulated user %s failed.',
+                                              user_id)
+        stats.add('user_errors')
+
+
+def _simulate_user(replay, bot_request, user_id, think_time, latencies,
+                   result_latencies, stats):
+    from telegram_svc import WORKING_TEXT
+
+    user_data = replay.dispatcher.user_data[user_id]
+    for step, build, payload in scenario(user_id, user_data):
+        started = time.perf_counter()
+        latency = replay.send(build, user_id, payload)
+        if latency is None:
+            stats.add('timeouts')
+            return
+        latencies.append((step, latency))
+        if bot_request.last_text.get(user_id) == WORKING_TEXT:
+            if not wait_for_result(bot_request, user_id, replay.timeout):
+                stats.add('timeouts')
+                return
+            result_latencies.append((step, time.perf_counter() - started))
+        time.sleep(think_time)
+    stats.add('completed_flows')
+
+
+def run(args, users, first_user_id, replay, bot_request, stats):
+    from database import session
+    from models import Task
+    from telegram_svc import auth_cache
+
+    # Fresh ids every run, so no pooled client or cached auth is reused.
+    user_ids = list(range(first_user_id, first_user_id + users))
+    reset_database()
+    seed_users(user_ids)
+    auth_cache.invalidate()
+    stats.reset()
+
+    latencies = []
+    result_latencies = []
+    threads = [threading.Thread(target=simulate_user,
+                                args=(replay, bot_request, user_id,
+                                      args.think_time, latencies,
+                                      result_latencies, stats))
+               for user_id in user_ids]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+
+    active_tasks = session.query(Task).filter(Task.active == True).count()
+    session.remove()
+
+    values = [latency for _, latency in latencies]
+    steps = {}
+    for step, latency in latencies:
+        steps.setdefault(step, {}).setdefault('handled', []).append(latency)
+    for step, latency in result_latencies:
+        steps.setdefault(step, {}).setdefault('result', []).append(latency)
+    return {
+        'users': users,
+        'updates': len(values),
+        'wall_seconds': wall_seconds,
+        'updates_per_second': len(values) / wall_seconds if wall_seconds else None,
+        'p50_seconds': percentile(values, 50),
+        'p95_seconds': percentile(values, 95),
+        'p99_seconds': percentile(values, 99),
+        'max_seconds': max(values) if values else None,
+        'completed_flows': stats.get('completed_flows'),
+        'active_tasks': active_tasks,
+        'timeouts': stats.get('timeouts'),
+        'handler_errors': stats.get('handler_errors'),
+        'user_errors': stats.get('user_errors'),
+        'steps': {step: {'{}_{}_seconds'.format(kind, p): percentile(values, p)
+                         for kind, values in kinds.items() for p in (50, 95)}
+                  for step, kinds in steps.items()},
+    }
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    configure_environment(args)
+
+    import config
+    from client_pool import pool
+    from telegram_bot import dispatcher
+    from benchmarks.fakes import FakeClientFactory, FakeBotRequest, \
+        FakeDialog, Stats
+
+    config.logger.setLevel('WARNING')
+    stats = Stats()
+    now = datetime.datetime.now()
+    dialogs = [FakeDialog(-(i + 1), 'Group {}'.format(i), date=now)
+               for i in range(args.groups)]
+    pool.factory = FakeClientFactory(stats=stats, latency=args.telethon_latency,
+                                     dialogs=dialogs)
+    bot_request = FakeBotRequest(latency=args.bot_latency, stats=stats)
+    dispatcher.bot._request = bot_request
+    logging.getLogger('telegram.ext.dispatcher').addHandler(ErrorCounter(stats))
+
+    if args.workers:
+        from webhook import UpdateWorkers
+        workers = UpdateWorkers(dispatcher, args.workers, max(args.users) * args.workers)
+        replay = Replay(dispatcher, workers.submit, args.timeout)
+    else:
+        replay = Replay(dispatcher, dispatcher.update_queue.put, args.timeout)
+        threading.Thread(target=dispatcher.start, daemon=True).start()
+
+    results = []
+    first_user_id = 1
+    for users in args.users:
+        results.append(run(args, users, first_user_id, replay,
+                           bot_request, stats))
+        first_user_id += users
+    if not args.workers:
+        dispatcher.stop()
+
+    report = {
+        'revision': git_revision(),
+        'created_at': datetime.datetime.now().isoformat(),
+        'parameters': vars(args),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    incomplete = [r for r in results if r['completed_flows'] < r['users']]
+    if incomplete:
+        sys.exit('Only {} of {} simulated users completed their flow.'.format(
+            incomplete[0]['completed_flows'], incomplete[0]['users']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import threading
+
+import config
+
+
+class BufferedWriter:
+    """Buffers rows in memory and writes them to the database in batches.
+
+    ``record`` only appends to a list, so it is cheap enough for the send
+    loop. ``run`` writes the buffer every ``flush_interval`` seconds, or as
+    soon as ``batch_size`` rows are waiting. Subclasses implement
+    ``_write(rows)``; rows it fails to write are kept for the next flush,
+    up to ``max_buffer`` of them.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_buffer):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._rows = []
+        self._lock = threading.Lock()
+        # Lets other threads wait for a flush the writer thread has started.
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def _append(self, row):
+        with self._lock:
+            self._rows.append(row)
+            full = len(self._rows) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            self._idle()
+
+    def _idle(self):
+        """Called after every flush of ``run``."""
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return
+            try:
+                self._write(rows)
+            except Exception as e:
+                config.logger.exception(e)
+                with self._lock:
+                    # Keep the rows for the next flush, but never let a
+                    # database outage grow the buffer without bound.
+                    self._rows = (rows + self._rows)[-self.max_buffer:]
+
+    def _write(self, rows):
+        raise NotImplementedError
@@ -0,0 +1,157 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from telethon import TelegramClient
+
+import config
+import metrics
+from session_store import create_session
+
+
+def api_credentials(user):
+    return (user.api_id if user.api_id else config.TELEGRAM_API_ID,
+            user.api_hash if user.api_hash else config.TELEGRAM_API_HASH)
+
+
+def create_client(phone_number, api_id, api_hash):
+    return TelegramClient(create_session(phone_number), api_id, api_hash)
+
+
+class _PooledClient:
+
+    def __init__(self, client):
+        self.client = client
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class ClientPool:
+    """Keeps connected Telethon clients, one per account and API credentials.
+
+    Idle clients are disconnected after ``ttl`` seconds, and the least
+    recently used idle client is evicted once ``max_size`` clients are open.
+    When all ``max_size`` clients are in use, a checkout for another account
+    waits until one is returned, so ``max_size`` must be larger than the
+    number of threads that use clients at the same time.
+    """
+
+    def __init__(self, ttl, max_size, factory=create_client):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.factory = factory
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+
+    @contextmanager
+    def client(self, phone_number, api_id, api_hash):
+        key = (phone_number, api_id, api_hash)
+        pooled = self._acquire(key)
+        try:
+            if not pooled.client.is_connected():
+                self.connect(pooled.client)
+            yield pooled.client
+        except ConnectionError:
+            # Let the next checkout reconnect instead of reusing a dead socket.
+            self._disconnect(pooled.client)
+            raise
+        finally:
+            with self._lock:
+                pooled.in_use -= 1
+                pooled.last_used = time.monotonic()
+                if not pooled.in_use:
+                    self._returned.notify_all()
+
+    def run(self, phone_number, api_id, api_hash, func, *args):
+        """Calls ``func(client, *args)`` with a pooled client.
+
+        If the connection drops during the call, the client is reconnected
+        and ``func`` is called once more, so only pass calls that are safe
+        to repeat.
+        """
+        with self.client(phone_number, api_id, api_hash) as client:
+            try:
+                return func(client, *args)
+            except ConnectionError as e:
+                config.logger.warning('Connection of {} dropped, reconnecting: '
+                                      '{!r}'.format(phone_number, e))
+                self.reconnect(client)
+            return func(client, *args)
+
+    def connect(self, client):
+        """Connects a client, trying a second time if the first attempt fails."""
+        started = time.monotonic()
+        try:
+            client.connect()
+        except ConnectionError:
+            self._disconnect(client)
+            client.connect()
+        metrics.connect_seconds.observe(time.monotonic() - started)
+
+    def reconnect(self, client):
+        self._disconnect(client)
+        self.connect(client)
+
+    def _acquire(self, key):
+        with self._lock:
+            stale = self._collect_idle()
+            while True:
+                pooled = self._clients.get(key)
+                if pooled is not None:
+                    break
+                stale += self._make_room()
+                if len(self._clients) < self.max_size:
+                    pooled = _PooledClient(self.factory(*key))
+                    self._clients[key] = pooled
+                    break
+                # Every open client is in use; nothing can be evicted yet.
+                self._returned.wait()
+            pooled.in_use += 1
+        for client in stale:
+            self._disconnect(client)
+        return pooled
+
+    def _collect_idle(self):
+        now = time.monotonic()
+        expired = [key for key, pooled in self._clients.items()
+                   if not pooled.in_use and now - pooled.last_used > self.ttl]
+        return [self._clients.pop(key).client for key in expired]
+
+    def _make_room(self):
+        evicted = []
+        idle = sorted((pooled.last_used, key)
+                      for key, pooled in self._clients.items()
+                      if not pooled.in_use)
+        while len(self._clients) >= self.max_size and idle:
+            _, key = idle.pop(0)
+            evicted.append(self._clients.pop(key).client)
+        return evicted
+
+    def evict_idle(self):
+        with self._lock:
+            stale = self._collect_idle()
+        for client in stale:
+            self._disconnect(client)
+
+    def discard(self, phone_number):
+        with self._lock:
+            keys = [key for key in self._clients if key[0] == phone_number]
+            stale = [self._clients.pop(key).client for key in keys]
+        for client in stale:
+            self._disconnect(client)
+
+    def size(self):
+        with self._lock:
+            return len(self._clients)
+
+    @staticmethod
+    def _disconnect(client):
+        try:
+            client.disconnect()
+        except Exception as e:
+            config.logger.exception(e)
+
+
+pool = ClientPool(config.CLIENT_POOL_TTL, config.CLIENT_POOL_MAX_SIZE)
+metrics.open_clients.callback = pool.size
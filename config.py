@@ -1,4 +1,5 @@
 import os
+import socket
 import logging
 from decouple import config, Csv
 
@@ -18,3 +19,53 @@ TELEGRAM_API_ID = config('TELEGRAM_API_ID', cast=int)
 TELEGRAM_API_HASH = config('TELEGRAM_API_HASH')
 TELETHON_SESSIONS_DIR = os.path.join(BASEDIR, 'telethon_sessions')
 LOGS_GROUP_ID = config('LOGS_GROUP_ID', cast=int)
+SCHEDULER_RESYNC_INTERVAL = config('SCHEDULER_RESYNC_INTERVAL', default=30, cast=int)
+CLIENT_POOL_TTL = config('CLIENT_POOL_TTL', default=600, cast=int)
+CLIENT_POOL_MAX_SIZE = config('CLIENT_POOL_MAX_SIZE', default=100, cast=int)
+POSTING_WORKERS = config('POSTING_WORKERS', default=16, cast=int)
+POSTING_PER_ACCOUNT = config('POSTING_PER_ACCOUNT', default=1, cast=int)
+POSTING_RETRY_DELAY = config('POSTING_RETRY_DELAY', default=60, cast=int)
+SEND_RATE_PER_ACCOUNT = config('SEND_RATE_PER_ACCOUNT', default=1.0, cast=float)
+SEND_BURST_PER_ACCOUNT = config('SEND_BURST_PER_ACCOUNT', default=5, cast=int)
+SEND_RATE_PER_GROUP = config('SEND_RATE_PER_GROUP', default=0.0, cast=float)
+SEND_BURST_PER_GROUP = config('SEND_BURST_PER_GROUP', default=1, cast=int)
+SEND_RATE_MIN_FACTOR = config('SEND_RATE_MIN_FACTOR', default=0.1, cast=float)
+FLOOD_WAIT_MAX_SLEEP = config('FLOOD_WAIT_MAX_SLEEP', default=60, cast=int)
+FLOOD_WAIT_MAX_RETRIES = config('FLOOD_WAIT_MAX_RETRIES', default=3, cast=int)
+FLOOD_DEFAULT_WAIT = config('FLOOD_DEFAULT_WAIT', default=3600, cast=int)
+TASK_LEASE_SECONDS = config('TASK_LEASE_SECONDS', default=300, cast=int)
+WORKER_ID = config('WORKER_ID', default='{}:{}'.format(socket.gethostname(), os.getpid()))
+RUN_BOT = config('RUN_BOT', default=True, cast=bool)
+RUN_SCHEDULER = config('RUN_SCHEDULER', default=True, cast=bool)
+LOGS_DIGEST_WINDOW = config('LOGS_DIGEST_WINDOW', default=60, cast=int)
+LOGS_DIGEST_MAX_LINES = config('LOGS_DIGEST_MAX_LINES', default=50, cast=int)
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=10, cast=int)
+DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', default=20, cast=int)
+DB_POOL_RECYCLE = config('DB_POOL_RECYCLE', default=1800, cast=int)
+DB_POOL_PRE_PING = config('DB_POOL_PRE_PING', default=True, cast=bool)
+DIALOG_CACHE_TTL = config('DIALOG_CACHE_TTL', default=300, cast=int)
+DIALOG_CACHE_FULL_REFRESH = config('DIALOG_CACHE_FULL_REFRESH', default=86400, cast=int)
+AUTH_CACHE_TTL = config('AUTH_CACHE_TTL', default=60, cast=int)
+DELIVERY_LOG_BATCH_SIZE = config('DELIVERY_LOG_BATCH_SIZE', default=500, cast=int)
+DELIVERY_LOG_FLUSH_INTERVAL = config('DELIVERY_LOG_FLUSH_INTERVAL', default=5, cast=int)
+DELIVERY_LOG_MAX_BUFFER = config('DELIVERY_LOG_MAX_BUFFER', default=100000, cast=int)
+DELIVERY_LOG_RETENTION_DAYS = config('DELIVERY_LOG_RETENTION_DAYS', default=30, cast=int)
+METRICS_ADDRESS = config('METRICS_ADDRESS', default='127.0.0.1')
+METRICS_PORT = config('METRICS_PORT', default=0, cast=int)
+SCHEDULER_BATCH_SIZE = config('SCHEDULER_BATCH_SIZE', default=500, cast=int)
+BOT_MODE = config('BOT_MODE', default='polling')
+WEBHOOK_URL = config('WEBHOOK_URL', default='')
+WEBHOOK_LISTEN = config('WEBHOOK_LISTEN', default='127.0.0.1')
+WEBHOOK_PORT = config('WEBHOOK_PORT', default=8443, cast=int)
+WEBHOOK_PATH = config('WEBHOOK_PATH', default='/' + TELEGRAM_TOKEN)
+BOT_WORKERS = config('BOT_WORKERS', default=8, cast=int)
+UPDATE_QUEUE_SIZE = config('UPDATE_QUEUE_SIZE', default=1000, cast=int)
+TELETHON_WORKERS = config('TELETHON_WORKERS', default=8, cast=int)
+SEND_RETRY_DELAY = config('SEND_RETRY_DELAY', default=30, cast=int)
+SEND_RETRY_ATTEMPTS = config('SEND_RETRY_ATTEMPTS', default=3, cast=int)
+CHECKPOINT_BATCH_SIZE = config('CHECKPOINT_BATCH_SIZE', default=200, cast=int)
+CHECKPOINT_FLUSH_INTERVAL = config('CHECKPOINT_FLUSH_INTERVAL', default=1, cast=float)
+CHECKPOINT_MAX_BUFFER = config('CHECKPOINT_MAX_BUFFER', default=100000, cast=int)
+SCHEDULE_MODE = config('SCHEDULE_MODE', default='interval')
+SCHEDULE_JITTER = config('SCHEDULE_JITTER', default=0, cast=int)
+TELETHON_SESSION_STORE = config('TELETHON_SESSION_STORE', default='file')
@@ -1,12 +1,91 @@
-from sqlalchemy import create_engine
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 import config
 
-engine = create_engine(config.DATABASE_URI)
+engine_options = {'pool_pre_ping': config.DB_POOL_PRE_PING}
+if not config.DATABASE_URI.startswith('sqlite'):
+    # SQLite uses its own per-thread/null pools, which take no sizing options.
+    engine_options.update(pool_size=config.DB_POOL_SIZE,
+                          max_overflow=config.DB_MAX_OVERFLOW,
+                          pool_recycle=config.DB_POOL_RECYCLE)
+engine = create_engine(config.DATABASE_URI, **engine_options)
+
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine, 'connect')
+    def enable_foreign_keys(dbapi_connection, connection_record):
+        # SQLite ignores ON DELETE clauses unless this is set per connection.
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
 
 Base = declarative_base()
 
+# Keeps IN (...) lists under SQLite's limit of bound parameters.
+CHUNK_SIZE = 500
+
+
+def chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
 Session = sessionmaker(bind=engine)
-session = Session()
+# Every thread gets its own session. Call session.remove() when a unit of
+# work (an update, a scheduler tick) is over.
+session = scoped_session(Session)
+
+
+_queries = threading.local()
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    # Registered once: adding and removing listeners isn't safe while other
+    # threads run statements.
+    _queries.count = getattr(_queries, 'count', 0) + 1
+    statements = getattr(_queries, 'statements', None)
+    if statements is not None:
+        statements.append(statement)
+
+
+class QueryCounter:
+
+    def __init__(self, statements=None):
+        self.count = 0
+        self.statements = statements
+
+
+@contextmanager
+def count_queries(keep_statements=False):
+    """Count the SQL statements the current thread runs inside the block.
+
+    With ``keep_statements`` the counter also lists them.
+    """
+    counter = QueryCounter([] if keep_statements else None)
+    started = getattr(_queries, 'count', 0)
+    outer_statements = getattr(_queries, 'statements', None)
+    if keep_statements:
+        _queries.statements = counter.statements
+    try:
+        yield counter
+    finally:
+        counter.count = getattr(_queries, 'count', 0) - started
+        if keep_statements:
+            if outer_statements is not None:
+                outer_statements.extend(counter.statements)
+            _queries.statements = outer_statements
+
+
+@contextmanager
+def assert_max_queries(limit):
+    with count_queries(keep_statements=True) as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError('{} SQL statements executed, at most {} '
+                             'expected:\n{}'.format(counter.count, limit,
+                                                    '\n'.join(counter.statements)))
@@ -0,0 +1,64 @@
+import time
+import datetime
+
+import config
+from models import Delivery
+from database import engine
+from buffered_writer import BufferedWriter
+
+PURGE_INTERVAL = 3600
+
+SENT = 'sent'
+FLOOD_WAIT = 'flood_wait'
+FAILED = 'failed'
+
+
+class DeliveryLog(BufferedWriter):
+    """Buffers per-group send outcomes and writes them in batches.
+
+    The buffer is written with one multi-row INSERT every ``flush_interval``
+    seconds, or as soon as ``batch_size`` rows are waiting. Rows older than
+    ``retention_days`` are purged once an hour.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_buffer, retention_days):
+        super().__init__(batch_size, flush_interval, max_buffer)
+        self.retention_days = retention_days
+        self._purged_at = 0
+
+    def record(self, task_id, group_tg_id, phone_number, sent_at,
+               latency, outcome, error=None):
+        self._append({'task_id': task_id,
+                      'group_tg_id': group_tg_id,
+                      'phone_number': phone_number,
+                      'sent_at': sent_at,
+                      'latency': latency,
+                      'outcome': outcome,
+                      'error': error})
+
+    def _idle(self):
+        if time.monotonic() - self._purged_at > PURGE_INTERVAL:
+            self.purge()
+
+    @staticmethod
+    def _write(rows):
+        with engine.begin() as connection:
+            connection.execute(Delivery.__table__.insert(), rows)
+
+    def purge(self):
+        self._purged_at = time.monotonic()
+        expired = datetime.datetime.now() - \
+            datetime.timedelta(days=self.retention_days)
+        try:
+            with engine.begin() as connection:
+                connection.execute(Delivery.__table__.delete().where(
+                    Delivery.sent_at < expired
+                ))
+        except Exception as e:
+            config.logger.exception(e)
+
+
+delivery_log = DeliveryLog(config.DELIVERY_LOG_BATCH_SIZE,
+                           config.DELIVERY_LOG_FLUSH_INTERVAL,
+                           config.DELIVERY_LOG_MAX_BUFFER,
+                           config.DELIVERY_LOG_RETENTION_DAYS)
@@ -0,0 +1,124 @@
+import datetime
+import threading
+
+import config
+import peers
+from models import TelegramSession, CachedDialog
+from database import session
+from client_pool import pool, api_credentials
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _local_time(date):
+    # Telethon reports message dates in UTC.
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone().replace(tzinfo=None)
+
+
+def _read_groups(client, since):
+    groups = []
+    # Dialogs come newest first (after the pinned ones), so everything
+    # past the first one older than the last sync is already cached.
+    for dialog in client.iter_dialogs():
+        date = _local_time(dialog.date)
+        if since is not None and date is not None and \
+                not dialog.pinned and date < since:
+            break
+        if dialog.is_group:
+            peer_type, access_hash = peers.describe(
+                getattr(dialog, 'input_entity', None))
+            groups.append({'tg_id': dialog.id, 'title': dialog.title,
+                           'date': date, 'peer_type': peer_type,
+                           'access_hash': access_hash})
+    return groups
+
+
+def _fetch_groups(tg_session, since):
+    return pool.run(tg_session.phone_number, *api_credentials(tg_session.user),
+                    _read_groups, since)
+
+
+def refresh(tg_session):
+    now = datetime.datetime.now()
+    full = tg_session.dialogs_full_synced_at is None or \
+        (now - tg_session.dialogs_full_synced_at).total_seconds() > \
+        config.DIALOG_CACHE_FULL_REFRESH
+    since = None if full else tg_session.dialogs_synced_at
+
+    groups = _fetch_groups(tg_session, since)
+
+    cached = session.query(CachedDialog).filter(
+        CachedDialog.session_id == tg_session.id
+    )
+    if not full:
+        cached = cached.filter(
+            CachedDialog.tg_id.in_([g['tg_id'] for g in groups])
+        )
+    cached.delete(synchronize_session=False)
+    if groups:
+        session.bulk_insert_mappings(CachedDialog, [dict(g, session_id=tg_session.id)
+                                                    for g in groups])
+    tg_session.dialogs_synced_at = now
+    if full:
+        tg_session.dialogs_full_synced_at = now
+    session.commit()
+
+
+def _refresh_in_background(tg_session_id):
+    try:
+        tg_session = session.query(TelegramSession).filter(
+            TelegramSession.id == tg_session_id
+        ).first()
+        if tg_session:
+            refresh(tg_session)
+    except Exception as e:
+        config.logger.exception(e)
+    finally:
+        session.remove()
+        with _refreshing_lock:
+            _refreshing.discard(tg_session_id)
+
+
+def refresh_in_background(tg_session_id):
+    with _refreshing_lock:
+        if tg_session_id in _refreshing:
+            return
+        _refreshing.add(tg_session_id)
+    threading.Thread(target=_refresh_in_background,
+                     args=(tg_session_id,), daemon=True).start()
+
+
+def is_cached(tg_session):
+    """Whether ``get_groups`` can answer without waiting for Telegram."""
+    return tg_session.dialogs_synced_at is not None
+
+
+def get_groups(tg_session):
+    """Groups of the account for the picker, as dicts with ``id``,
+    ``title``, ``peer_type`` and ``access_hash``.
+
+    The first call for an account loads its dialogs from Telegram; later
+    calls answer from the database and refresh it in the background once it
+    is older than ``DIALOG_CACHE_TTL`` seconds.
+    """
+    synced_at = tg_session.dialogs_synced_at
+    if synced_at is None:
+        refresh(tg_session)
+    elif (datetime.datetime.now() - synced_at).total_seconds() > \
+            config.DIALOG_CACHE_TTL:
+        refresh_in_background(tg_session.id)
+
+    dialogs = session.query(
+        CachedDialog.tg_id, CachedDialog.title, CachedDialog.peer_type,
+        CachedDialog.access_hash
+    ).filter(
+        CachedDialog.session_id == tg_session.id
+    ).order_by(CachedDialog.date.desc()).all()
+    return [{'id': tg_id, 'title': title, 'peer_type': peer_type,
+             'access_hash': access_hash}
+            for tg_id, title, peer_type, access_hash in dialogs]
@@ -0,0 +1,57 @@
+import threading
+
+import config
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class LogDigest:
+    """Collects log lines in memory and posts them as one digest message.
+
+    A digest goes out every ``window`` seconds, or earlier once
+    ``max_lines`` lines are waiting. Sending happens on the digest's own
+    thread, so callers never wait for the Bot API.
+    """
+
+    def __init__(self, bot, chat_id, window, max_lines):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.window = window
+        self.max_lines = max_lines
+        self._lines = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def add(self, line):
+        with self._lock:
+            self._lines.append(line)
+            full = len(self._lines) >= self.max_lines
+        if full:
+            self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.window)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+        for text in self._messages(lines):
+            try:
+                self.bot.send_message(self.chat_id, text)
+            except Exception as e:
+                config.logger.exception(e)
+
+    @staticmethod
+    def _messages(lines):
+        text = ''
+        for line in lines:
+            line = line[:MAX_MESSAGE_LENGTH - 1]
+            if len(text) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+                yield text
+                text = ''
+            text += line + '\n'
+        if text:
+            yield text
@@ -0,0 +1,177 @@
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import config
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['{}{} {}'.format(self.name,
+                                 _format_labels(self.label_names, key),
+                                 _format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), callback=None):
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.callback is not None:
+            self.set(self.callback())
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = ['{}_bucket{} {}'.format(
+            self.name,
+            _format_labels(self.label_names, key, [('le', _format_value(bound))]),
+            count
+        ) for bound, count in zip(self.buckets, counts)]
+        labels = _format_labels(self.label_names, key)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, counts[-1]))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=(), callback=None):
+        return self.register(Gauge(name, description, labels, callback))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+sends = registry.counter('tgbot_sends_total',
+                         'Messages sent to groups, by outcome.', ['outcome'])
+send_seconds = registry.histogram('tgbot_send_seconds',
+                                  'Latency of send_message calls.')
+connect_seconds = registry.histogram('tgbot_client_connect_seconds',
+                                     'Latency of Telethon client.connect().')
+scheduler_lag = registry.gauge('tgbot_scheduler_lag_seconds',
+                               'Largest delay between a task being due and '
+                               'being picked up, in the last tick.')
+due_tasks = registry.gauge('tgbot_due_tasks',
+                           'Tasks that were due in the last tick.')
+tick_queries = registry.gauge('tgbot_tick_queries',
+                              'SQL statements run by the last scheduler tick.')
+open_clients = registry.gauge('tgbot_telethon_clients',
+                              'Telethon clients held by the client pool.')
+queued_updates = registry.gauge('tgbot_queued_updates',
+                                'Webhook updates waiting for a worker.')
+rejected_updates = registry.counter('tgbot_rejected_updates_total',
+                                    'Webhook updates refused because the '
+                                    'queue was full.')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(address, port):
+    server = HTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config.logger.info('Serving metrics on http://{}:{}/metrics'.format(address, port))
+    return server
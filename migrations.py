@@ -0,0 +1,200 @@
+import sys
+import datetime
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, \
+    inspect
+
+import config
+from database import Base, engine
+from models import Token, User, TelegramSession, Task, TelegramGroup, \
+    CachedDialog, Delivery, TaskRun, TaskRunGroup, TelethonSession, \
+    TelethonEntity
+from session_store import import_session_files
+
+version_table = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255)),
+    Column('applied_at', DateTime, default=datetime.datetime.now),
+)
+
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def _column(attribute):
+    return attribute.property.columns[0]
+
+
+def add_column(connection, attribute):
+    column = _column(attribute)
+    table = column.table.name
+    existing = [c['name'] for c in inspect(connection).get_columns(table)]
+    if column.name in existing:
+        return
+    connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        _quote(connection, table), _quote(connection, column.name),
+        column.type.compile(dialect=connection.dialect)
+    ))
+
+
+def create_table(connection, model):
+    model.__table__.create(bind=connection, checkfirst=True)
+
+
+def create_index(connection, model, name):
+    existing = [i['name'] for i in inspect(connection).get_indexes(model.__tablename__)]
+    if name in existing:
+        return
+    index = next(i for i in model.__table__.indexes if i.name == name)
+    index.create(bind=connection)
+
+
+def recreate_index(connection, model, name):
+    existing = [i['name'] for i in inspect(connection).get_indexes(model.__tablename__)]
+    if name in existing:
+        connection.execute('DROP INDEX {}'.format(_quote(connection, name)))
+    create_index(connection, model, name)
+
+
+def set_on_delete(connection, attribute, on_delete):
+    # SQLite can't alter constraints; the handlers delete dependent rows
+    # explicitly, so old SQLite databases keep working without cascades.
+    if connection.dialect.name != 'postgresql':
+        return
+    column = _column(attribute)
+    table = column.table.name
+    foreign_key = next(iter(column.foreign_keys))
+    for constraint in inspect(connection).get_foreign_keys(table):
+        if constraint['constrained_columns'] == [column.name]:
+            connection.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(
+                _quote(connection, table), _quote(connection, constraint['name'])
+            ))
+    connection.execute(
+        'ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {} ({}) '
+        'ON DELETE {}'.format(
+            _quote(connection, table), _quote(connection, column.name),
+            _quote(connection, foreign_key.column.table.name),
+            _quote(connection, foreign_key.column.name), on_delete
+        )
+    )
+
+
+def scheduler_columns(connection):
+    add_column(connection, Task.next_run_at)
+    add_column(connection, Task.lease_owner)
+    add_column(connection, Task.lease_expires_at)
+    add_column(connection, TelegramSession.dialogs_synced_at)
+    add_column(connection, TelegramSession.dialogs_full_synced_at)
+    create_table(connection, CachedDialog)
+
+
+def hot_query_indexes(connection):
+    create_index(connection, Token, 'ix_token_value')
+    create_index(connection, TelegramSession, 'ix_telegram_session_user_id')
+    create_index(connection, TelegramSession, 'ix_telegram_session_phone_number')
+    create_index(connection, Task, 'ix_task_user_id')
+    create_index(connection, Task, 'ix_task_session_id')
+    create_index(connection, Task, 'ix_task_active_next_run_at')
+    create_index(connection, TelegramGroup, 'ix_telegram_group_task_id')
+    create_index(connection, CachedDialog, 'ix_cached_dialog_session_id')
+
+
+def cascading_foreign_keys(connection):
+    set_on_delete(connection, User.token_id, 'SET NULL')
+    set_on_delete(connection, TelegramSession.user_id, 'CASCADE')
+    set_on_delete(connection, Task.user_id, 'CASCADE')
+    set_on_delete(connection, Task.session_id, 'CASCADE')
+    set_on_delete(connection, TelegramGroup.task_id, 'CASCADE')
+    set_on_delete(connection, CachedDialog.session_id, 'CASCADE')
+
+
+def delivery_table(connection):
+    create_table(connection, Delivery)
+
+
+def task_run_tables(connection):
+    create_table(connection, TaskRun)
+    create_table(connection, TaskRunGroup)
+
+
+def telethon_session_tables(connection):
+    create_table(connection, TelethonSession)
+    create_table(connection, TelethonEntity)
+    count = import_session_files(connection)
+    config.logger.info('Imported {} session files.'.format(count))
+
+
+def peer_columns(connection):
+    add_column(connection, TelegramGroup.peer_type)
+    add_column(connection, TelegramGroup.access_hash)
+    add_column(connection, CachedDialog.peer_type)
+    add_column(connection, CachedDialog.access_hash)
+
+
+def partial_task_index(connection):
+    # Migration 2 built it over every task on SQLite.
+    if connection.dialect.name == 'sqlite':
+        recreate_index(connection, Task, 'ix_task_active_next_run_at')
+
+
+# Append new migrations at the end; never edit or reorder applied ones.
+MIGRATIONS = [
+    (1, 'Scheduler, lease and dialog cache columns', scheduler_columns),
+    (2, 'Indexes for hot queries', hot_query_indexes),
+    (3, 'Cascading foreign keys', cascading_foreign_keys),
+    (4, 'Delivery log', delivery_table),
+    (5, 'Task run checkpoints', task_run_tables),
+    (6, 'Telethon sessions in the database', telethon_session_tables),
+    (7, 'Peer types and access hashes of groups', peer_columns),
+    (8, 'Partial index of active tasks on SQLite', partial_task_index),
+]
+
+
+def current_version(connection):
+    version_table.create(bind=connection, checkfirst=True)
+    versions = [row.version for row in connection.execute(version_table.select())]
+    return max(versions) if versions else 0
+
+
+def stamp(connection, version, description):
+    connection.execute(version_table.insert().values(version=version,
+                                                     description=description))
+
+
+def upgrade():
+    with engine.begin() as connection:
+        if Task.__tablename__ not in inspect(connection).get_table_names():
+            # A new database gets the current schema in one go.
+            Base.metadata.create_all(connection)
+            version_table.create(bind=connection, checkfirst=True)
+            for version, description, _ in MIGRATIONS:
+                stamp(connection, version, description)
+            config.logger.info('Database created at schema version '
+                               '{}.'.format(MIGRATIONS[-1][0]))
+            return
+
+    for version, description, migrate in MIGRATIONS:
+        with engine.begin() as connection:
+            if version <= current_version(connection):
+                continue
+            config.logger.info('Applying migration {}: {}'.format(version,
+                                                                  description))
+            migrate(connection)
+            stamp(connection, version, description)
+
+
+def status():
+    with engine.begin() as connection:
+        version = current_version(connection)
+    for number, description, _ in MIGRATIONS:
+        print('{} {:>3} {}'.format('*' if number <= version else ' ',
+                                   number, description))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['status']:
+        status()
+    else:
+        upgrade()
@@ -1,17 +1,18 @@
 import datetime
 
 from sqlalchemy import Column, Date, Integer, String, \
-    ForeignKey, DateTime, Boolean, BigInteger
-from sqlalchemy.orm import relationship
+    ForeignKey, DateTime, Boolean, BigInteger, Index, Float, LargeBinary
+from sqlalchemy.orm import relationship, backref
 
 from database import Base
+from scheduler import next_run_time
 
 
 class Token(Base):
     __tablename__ = "token"
 
     id = Column(Integer, primary_key=True)
-    value = Column(String(100))
+    value = Column(String(100), index=True)
     valid_until = Column(Date)
 
     def __init__(self, value, valid_until):
@@ -23,7 +24,7 @@ class User(Base):
     __tablename__ = "user"
 
     tg_id = Column(Integer, primary_key=True)
-    token_id = Column(Integer, ForeignKey('token.id'))
+    token_id = Column(Integer, ForeignKey('token.id', ondelete='SET NULL'))
     token = relationship('Token')
     api_id = Column(Integer)
     api_hash = Column(String(100))
@@ -38,11 +39,14 @@ class TelegramSession(Base):
     __tablename__ = "telegram_session"
 
     id = Column(Integer, primary_key=True)
-    phone_number = Column(String(50))
+    phone_number = Column(String(50), index=True)
     phone_code_hash = Column(String(100))
     created_at = Column(DateTime, default=datetime.datetime.now)
     active = Column(Boolean, default=False)
-    user_id = Column(Integer, ForeignKey('user.tg_id'))
+    dialogs_synced_at = Column(DateTime)
+    dialogs_full_synced_at = Column(DateTime)
+    user_id = Column(Integer, ForeignKey('user.tg_id', ondelete='CASCADE'),
+                     index=True)
     user = relationship('User')
 
     def __init__(self, phone_number, phone_code_hash, user):
@@ -60,9 +64,14 @@ class Task(Base):
     created_at = Column(DateTime, default=datetime.datetime.now)
     active = Column(Boolean, default=False)
     last_message_date = Column(DateTime)
-    user_id = Column(Integer, ForeignKey('user.tg_id'))
+    next_run_at = Column(DateTime)
+    lease_owner = Column(String(100))
+    lease_expires_at = Column(DateTime)
+    user_id = Column(Integer, ForeignKey('user.tg_id', ondelete='CASCADE'),
+                     index=True)
     user = relationship('User')
-    session_id = Column(Integer, ForeignKey('telegram_session.id'))
+    session_id = Column(Integer, ForeignKey('telegram_session.id', ondelete='CASCADE'),
+                        index=True)
     session = relationship('TelegramSession')
 
     def __init__(self, user, session, message=None, interval=None):
@@ -71,6 +80,17 @@ class Task(Base):
         self.message = message
         self.interval = interval
 
+    def schedule_next_run(self):
+        self.next_run_at = next_run_time(self.id, self.interval,
+                                         self.last_message_date)
+
+
+# The scheduler only ever reads active tasks; the index leaves the
+# inactive ones out altogether.
+Index('ix_task_active_next_run_at', Task.active, Task.next_run_at,
+      postgresql_where=Task.active == True,
+      sqlite_where=Task.active == True)
+
 
 class TelegramGroup(Base):
     __tablename__ = "telegram_group"
@@ -78,10 +98,140 @@ class TelegramGroup(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String(255))
     tg_id = Column(BigInteger)
-    task_id = Column(Integer, ForeignKey('task.id'))
-    task = relationship('Task')
-
-    def __init__(self, title, tg_id, task):
+    # See peers.py; empty for groups picked before these were stored.
+    peer_type = Column(String(10))
+    access_hash = Column(BigInteger)
+    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'),
+                     index=True)
+    task = relationship('Task', backref=backref('groups', passive_deletes=True))
+
+    def __init__(self, title, tg_id, task, peer_type=None, access_hash=None):
         self.title = title
         self.tg_id = tg_id
         self.task = task
+        self.peer_type = peer_type
+        self.access_hash = access_hash
+
+
+class CachedDialog(Base):
+    __tablename__ = "cached_dialog"
+
+    id = Column(Integer, primary_key=True)
+    title = Column(String(255))
+    tg_id = Column(BigInteger)
+    peer_type = Column(String(10))
+    access_hash = Column(BigInteger)
+    date = Column(DateTime)
+    session_id = Column(Integer, ForeignKey('telegram_session.id', ondelete='CASCADE'),
+                        index=True)
+    session = relationship('TelegramSession')
+
+    def __init__(self, title, tg_id, date, session, peer_type=None,
+                 access_hash=None):
+        self.title = title
+        self.tg_id = tg_id
+        self.date = date
+        self.session = session
+        self.peer_type = peer_type
+        self.access_hash = access_hash
+
+
+class Delivery(Base):
+    __tablename__ = "delivery"
+
+    # Append-only history: no foreign keys, so deleting a task keeps its
+    # deliveries until they are purged.
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    task_id = Column(Integer, index=True)
+    group_tg_id = Column(BigInteger)
+    phone_number = Column(String(50))
+    sent_at = Column(DateTime, index=True)
+    latency = Column(Float)
+    outcome = Column(String(20))
+    error = Column(String(100))
+
+    def __init__(self, task_id, group_tg_id, phone_number, sent_at,
+                 latency, outcome, error=None):
+        self.task_id = task_id
+        self.group_tg_id = group_tg_id
+        self.phone_number = phone_number
+        self.sent_at = sent_at
+        self.latency = latency
+        self.outcome = outcome
+        self.error = error
+
+
+class TaskRun(Base):
+    __tablename__ = "task_run"
+
+    # A run exists only while it is unfinished: from the first send until
+    # every group has been sent to, skipped or given up on.
+    id = Column(String(32), primary_key=True)
+    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'),
+                     index=True)
+    started_at = Column(DateTime, default=datetime.datetime.now)
+
+    def __init__(self, id, task_id, started_at=None):
+        self.id = id
+        self.task_id = task_id
+        self.started_at = started_at
+
+
+class TaskRunGroup(Base):
+    __tablename__ = "task_run_group"
+
+    # Groups of a run that have been attempted. No foreign key on group_id:
+    # a group removed mid-run must not make its checkpoint fail.
+    run_id = Column(String(32), ForeignKey('task_run.id', ondelete='CASCADE'),
+                    primary_key=True)
+    group_id = Column(Integer, primary_key=True, autoincrement=False)
+    status = Column(String(20))
+    attempts = Column(Integer, default=0)
+
+    def __init__(self, run_id, group_id, status, attempts=0):
+        self.run_id = run_id
+        self.group_id = group_id
+        self.status = status
+        self.attempts = attempts
+
+
+class TelethonSession(Base):
+    __tablename__ = "telethon_session"
+
+    # What Telethon keeps in the sessions table of <phone_number>.session.
+    phone_number = Column(String(50), primary_key=True)
+    dc_id = Column(Integer)
+    server_address = Column(String(100))
+    port = Column(Integer)
+    auth_key = Column(LargeBinary)
+    updated_at = Column(DateTime, default=datetime.datetime.now)
+
+    def __init__(self, phone_number, dc_id, server_address, port, auth_key):
+        self.phone_number = phone_number
+        self.dc_id = dc_id
+        self.server_address = server_address
+        self.port = port
+        self.auth_key = auth_key
+
+
+class TelethonEntity(Base):
+    __tablename__ = "telethon_entity"
+
+    # Telethon's entity cache: access hashes of the users, chats and channels
+    # an account has seen. No foreign key, so entities can be written before
+    # the account's auth key.
+    phone_number = Column(String(50), primary_key=True)
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    hash = Column(BigInteger)
+    username = Column(String(100))
+    phone = Column(String(50))
+    name = Column(String(255))
+
+    def __init__(self, phone_number, id, hash, username=None, phone=None,
+                 name=None):
+        self.phone_number = phone_number
+        self.id = id
+        self.hash = hash
+        self.username = username
+        self.phone = phone
+        self.name = name
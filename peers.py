@@ -0,0 +1,30 @@
+"""Input peers of target groups, built from what is stored with them.
+
+Sending to a bare id makes Telethon look the group up in the account's
+entity cache, which fails when that cache is cold. The peer type and access
+hash saved with every group and cached dialog let the send path build the
+input peer itself.
+"""
+from telethon import utils
+from telethon.tl.types import InputPeerChat, InputPeerChannel
+
+CHAT = 'chat'
+CHANNEL = 'channel'
+
+
+def describe(peer):
+    """``(peer_type, access_hash)`` of an input peer, or ``(None, None)``."""
+    if isinstance(peer, InputPeerChannel):
+        return CHANNEL, peer.access_hash
+    if isinstance(peer, InputPeerChat):
+        return CHAT, None
+    return None, None
+
+
+def input_peer(tg_id, peer_type, access_hash):
+    if peer_type == CHAT:
+        return InputPeerChat(utils.resolve_id(tg_id)[0])
+    if peer_type == CHANNEL and access_hash:
+        return InputPeerChannel(utils.resolve_id(tg_id)[0], access_hash)
+    # Stored before peer types were; Telethon resolves the id itself.
+    return tg_id
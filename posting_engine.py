@@ -0,0 +1,57 @@
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PostingEngine:
+    """Runs posting jobs on a shared thread pool.
+
+    ``max_workers`` caps the number of jobs running at once across all
+    accounts, ``per_account`` caps the jobs running for the same account.
+    Jobs over the per-account cap wait in a queue of their own instead of
+    occupying a worker.
+    """
+
+    def __init__(self, max_workers, per_account):
+        self.per_account = per_account
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._running = defaultdict(int)
+        self._pending = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def submit(self, account, func, *args, callback=None):
+        with self._lock:
+            if self._running[account] >= self.per_account:
+                self._pending[account].append((func, args, callback))
+                return
+            self._running[account] += 1
+        self._start(account, func, args, callback)
+
+    def _start(self, account, func, args, callback):
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(
+            lambda f: self._finished(account, f, callback)
+        )
+
+    def _finished(self, account, future, callback):
+        with self._lock:
+            if self._pending[account]:
+                next_job = self._pending[account].popleft()
+            else:
+                next_job = None
+                self._running[account] -= 1
+                if not self._running[account]:
+                    del self._running[account]
+                    del self._pending[account]
+        if next_job is not None:
+            self._start(account, *next_job)
+        if callback is not None:
+            callback(future)
+
+    def in_flight(self):
+        with self._lock:
+            return sum(self._running.values()) + \
+                sum(len(q) for q in self._pending.values())
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,92 @@
+import time
+import threading
+
+import config
+
+
+class TokenBucket:
+    """Token bucket whose rate backs off when Telegram asks us to slow down.
+
+    ``reserve`` always takes a token and returns how long the caller has to
+    wait before using it, so concurrent callers queue up fairly without
+    holding a lock while they sleep.
+    """
+
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def reserve(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, now, seconds):
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(self.tokens, 0)
+        self.rate = max(self.rate / 2, self.max_rate * config.SEND_RATE_MIN_FACTOR)
+
+    def reward(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.01)
+
+
+class RateLimiter:
+    """Per-account and, optionally, per-group send pacing."""
+
+    def __init__(self, account_rate, account_burst, group_rate=0, group_burst=1):
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self._accounts = {}
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def _account(self, account):
+        bucket = self._accounts.get(account)
+        if bucket is None:
+            bucket = TokenBucket(self.account_rate, self.account_burst)
+            self._accounts[account] = bucket
+        return bucket
+
+    def _group(self, group):
+        bucket = self._groups.get(group)
+        if bucket is None:
+            bucket = TokenBucket(self.group_rate, self.group_burst)
+            self._groups[group] = bucket
+        return bucket
+
+    def acquire(self, account, group=None):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._account(account).reserve(now)
+            if self.group_rate and group is not None:
+                wait = max(wait, self._group(group).reserve(now))
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeeded(self, account):
+        with self._lock:
+            self._account(account).reward()
+
+    def pause(self, account, seconds):
+        with self._lock:
+            self._account(account).pause(time.monotonic(), seconds)
+
+    def paused_for(self, account):
+        with self._lock:
+            bucket = self._accounts.get(account)
+            if bucket is None:
+                return 0
+            return max(0, bucket.paused_until - time.monotonic())
+
+
+limiter = RateLimiter(config.SEND_RATE_PER_ACCOUNT, config.SEND_BURST_PER_ACCOUNT,
+                      config.SEND_RATE_PER_GROUP, config.SEND_BURST_PER_GROUP)
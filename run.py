@@ -1,10 +1,27 @@
-import schedule
+import config
+import metrics
+from thread_svc import start_schedule, run_threaded, log_digest
+from delivery_log import delivery_log
+from task_runs import checkpoints
+from task_events import task_events
 
-from telegram_bot import updater
-from thread_svc import start_schedule, run_threaded, posting_messages
 
+if config.METRICS_PORT:
+    metrics.start_http_server(config.METRICS_ADDRESS, config.METRICS_PORT)
 
-schedule.every().second.do(posting_messages)
-run_threaded(start_schedule)
+if config.RUN_SCHEDULER:
+    run_threaded(log_digest.run)
+    run_threaded(delivery_log.run)
+    run_threaded(checkpoints.run)
+    run_threaded(task_events.listen)
+    run_threaded(start_schedule)
 
-updater.start_polling()
+if config.RUN_BOT:
+    from telegram_bot import updater
+    if config.BOT_MODE == 'webhook':
+        from webhook import start_webhook
+        if start_webhook(updater.dispatcher) is None:
+            config.logger.warning('Falling back to polling.')
+            updater.start_polling()
+    else:
+        updater.start_polling()
@@ -0,0 +1,141 @@
+import math
+import heapq
+import random
+import threading
+import datetime
+
+import config
+
+INTERVAL = 'interval'
+FIXED_RATE = 'fixed_rate'
+
+# Fixed-rate slots of every task are counted from this instant.
+EPOCH = datetime.datetime(2000, 1, 1)
+# Multiples of the golden ratio, modulo 1, fill [0, 1) evenly whatever the
+# number of tasks, so consecutive task ids get well separated phases.
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+
+
+class TaskScheduler:
+    """Min-heap of active tasks keyed on their next run time.
+
+    Heap entries are never removed in place: rescheduling a task pushes a new
+    entry and the old one is skipped when it reaches the top, because it no
+    longer matches ``_deadlines``.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def schedule(self, task_id, run_at):
+        with self._lock:
+            if task_id in self._running:
+                return
+            self._deadlines[task_id] = run_at
+            heapq.heappush(self._heap, (run_at, task_id))
+        self._wakeup.set()
+
+    def unschedule(self, task_id):
+        with self._lock:
+            self._deadlines.pop(task_id, None)
+
+    def load(self, deadlines):
+        with self._lock:
+            self._deadlines = {task_id: run_at
+                               for task_id, run_at in deadlines
+                               if task_id not in self._running}
+            self._heap = [(run_at, task_id)
+                          for task_id, run_at in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def pop_due(self, now, limit=None):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and \
+                    (limit is None or len(due) < limit):
+                run_at, task_id = heapq.heappop(self._heap)
+                if self._deadlines.get(task_id) != run_at:
+                    continue
+                del self._deadlines[task_id]
+                self._running.add(task_id)
+                due.append(task_id)
+        return due
+
+    def done(self, task_id, next_run_at=None):
+        with self._lock:
+            self._running.discard(task_id)
+        if next_run_at is not None:
+            self.schedule(task_id, next_run_at)
+
+    def running(self):
+        with self._lock:
+            return list(self._running)
+
+    def next_run_at(self):
+        with self._lock:
+            while self._heap:
+                run_at, task_id = self._heap[0]
+                if self._deadlines.get(task_id) == run_at:
+                    return run_at
+                heapq.heappop(self._heap)
+        return None
+
+    def wait(self, timeout):
+        next_run_at = self.next_run_at()
+        if next_run_at is not None:
+            until_next = (next_run_at - datetime.datetime.now()).total_seconds()
+            timeout = min(timeout, until_next)
+        if timeout > 0:
+            self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+
+def _jitter(task_id, slot, jitter):
+    # Seeded by the slot, so the same slot always gets the same offset.
+    return random.Random(task_id * 1000003 + slot).uniform(-jitter, jitter)
+
+
+def fixed_rate_slot(task_id, interval, after, jitter=0):
+    """The task's first fixed-rate slot strictly after ``after``.
+
+    Slots are ``interval`` seconds apart, shifted from ``EPOCH`` by a phase
+    derived from the task id. Tasks sharing an interval are spread over it
+    instead of firing together, and since slots never depend on when a run
+    finished the average interval stays exact. ``jitter`` moves each slot by
+    up to that many seconds, less than half an interval.
+    """
+    offset = (task_id * GOLDEN_RATIO) % 1 * interval
+    jitter = min(jitter, interval * 0.49)
+    slot = math.floor(((after - EPOCH).total_seconds() - offset) / interval)
+    while True:
+        run_at = EPOCH + datetime.timedelta(
+            seconds=offset + slot * interval +
+            (_jitter(task_id, slot, jitter) if jitter else 0)
+        )
+        if run_at > after:
+            return run_at
+        slot += 1
+
+
+def next_run_time(task_id, interval, last_run_at):
+    """Next run of a task every ``interval`` minutes, per ``SCHEDULE_MODE``."""
+    if last_run_at is None:
+        return datetime.datetime.now()
+    if config.SCHEDULE_MODE == FIXED_RATE:
+        return fixed_rate_slot(task_id, interval * 60, last_run_at,
+                               config.SCHEDULE_JITTER)
+    return last_run_at + datetime.timedelta(minutes=interval)
+
+
+task_scheduler = TaskScheduler()
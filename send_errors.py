@@ -0,0 +1,54 @@
+"""Sorts errors from sending a message to a group into what to do next."""
+from telethon import errors
+
+# Try the group again later.
+TRANSIENT = 'transient'
+# The account has to slow down; nothing is wrong with the group.
+RATE_LIMIT = 'rate_limit'
+# The group can't be posted to by this account; skip it.
+GROUP = 'group'
+# The account itself is unusable; deactivate the task.
+ACCOUNT = 'account'
+
+
+def _errors(*names):
+    # Not every Telethon release has every error class.
+    return tuple(getattr(errors, name) for name in names if hasattr(errors, name))
+
+
+_CLASSES = [
+    (RATE_LIMIT, _errors('FloodError', 'PeerFloodError')),
+    # Checked before GROUP: the restrictions on writing to any group are
+    # BadRequest and Forbidden errors too.
+    (ACCOUNT, _errors('UnauthorizedError', 'AuthKeyError',
+                      'PhoneNumberBannedError', 'UserDeactivatedBanError',
+                      'UserBannedInChannelError', 'UserRestrictedError')),
+    (TRANSIENT, _errors('ServerError', 'RpcCallFailError', 'TimeoutError',
+                        'SlowModeWaitError') + (ConnectionError, TimeoutError)),
+    # ValueError is what Telethon raises for an entity it can't resolve.
+    (GROUP, _errors('BadRequestError', 'ForbiddenError', 'NotFoundError') +
+     (ValueError,)),
+]
+
+
+# Telegram rejected the input peer, possibly for a stale access hash.
+_STALE_PEER = _errors('ChannelInvalidError', 'PeerIdInvalidError')
+
+
+def classify(error):
+    for kind, classes in _CLASSES:
+        if isinstance(error, classes):
+            return kind
+    return TRANSIENT
+
+
+def wait_seconds(error):
+    """How long Telegram asked to wait before the next attempt.
+
+    None when the error doesn't say, as with PeerFlood.
+    """
+    return getattr(error, 'seconds', None) or None
+
+
+def stale_peer(error):
+    return isinstance(error, _STALE_PEER)
@@ -0,0 +1,271 @@
+"""Where Telethon keeps the login of every account.
+
+With ``TELETHON_SESSION_STORE=file`` (the default) each account has its own
+SQLite file, ``telethon_sessions/<phone_number>.session``. With
+``TELETHON_SESSION_STORE=database`` the auth key and the entity cache live
+in the ``telethon_session`` and ``telethon_entity`` tables, so any worker
+can load any account.
+
+    python session_store.py
+
+copies the ``.session`` files that aren't in the database yet; migration 6
+does it once on its own.
+"""
+import os
+import glob
+import sqlite3
+import datetime
+import threading
+
+from sqlalchemy import select
+from telethon import utils
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+
+import config
+from database import engine, chunks
+from models import TelethonSession, TelethonEntity
+
+FILE = 'file'
+DATABASE = 'database'
+EXTENSION = '.session'
+
+session_table = TelethonSession.__table__
+entity_table = TelethonEntity.__table__
+
+
+def session_path(phone_number):
+    return os.path.join(config.TELETHON_SESSIONS_DIR, phone_number)
+
+
+def _entity_mapping(phone_number, row):
+    id, hash, username, phone, name = row
+    return {'phone_number': phone_number, 'id': id, 'hash': hash,
+            'username': username,
+            'phone': str(phone) if phone is not None else None,
+            'name': name}
+
+
+class DatabaseSession(MemorySession):
+    """Telethon session stored in the database instead of a file.
+
+    The account's rows are read once, when the session is created, and
+    every lookup is served from memory. Changes are written behind, by
+    ``save()``: Telethon calls it as soon as the auth key or data center
+    changes, and ``close()`` calls it when the client disconnects, which
+    stores the entities seen since. Update states and uploaded files are
+    kept in memory only; the bot neither receives updates nor uploads.
+    """
+
+    def __init__(self, phone_number):
+        super().__init__()
+        self.phone_number = phone_number
+        self._entities = {}
+        self._changed = False
+        self._changed_entities = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        with engine.connect() as connection:
+            row = connection.execute(session_table.select().where(
+                session_table.c.phone_number == self.phone_number
+            )).first()
+            entities = connection.execute(select([
+                entity_table.c.id, entity_table.c.hash, entity_table.c.username,
+                entity_table.c.phone, entity_table.c.name
+            ]).where(
+                entity_table.c.phone_number == self.phone_number
+            )).fetchall()
+        if row is not None:
+            self._dc_id = row.dc_id or 0
+            self._server_address = row.server_address
+            self._port = row.port
+            self._auth_key = AuthKey(data=row.auth_key) if row.auth_key else None
+        self._entities = {entity[0]: tuple(entity) for entity in entities}
+
+    def clone(self, to_instance=None):
+        return super().clone(to_instance or MemorySession())
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._changed = True
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._changed = True
+
+    def process_entities(self, tlo):
+        rows = self._entities_to_rows(tlo)
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                if self._entities.get(row[0]) != row:
+                    self._entities[row[0]] = row
+                    self._changed_entities.add(row[0])
+
+    def _find(self, index, value):
+        with self._lock:
+            return next(((row[0], row[1]) for row in self._entities.values()
+                         if row[index] == value), None)
+
+    def get_entity_rows_by_phone(self, phone):
+        return self._find(3, str(phone))
+
+    def get_entity_rows_by_username(self, username):
+        return self._find(2, username)
+
+    def get_entity_rows_by_name(self, name):
+        return self._find(4, name)
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        ids = [id] if exact else [utils.get_peer_id(PeerUser(id)),
+                                  utils.get_peer_id(PeerChat(id)),
+                                  utils.get_peer_id(PeerChannel(id))]
+        with self._lock:
+            for found_id in ids:
+                row = self._entities.get(found_id)
+                if row is not None:
+                    return row[0], row[1]
+        return None
+
+    def save(self):
+        with self._lock:
+            changed, self._changed = self._changed, False
+            entity_ids, self._changed_entities = self._changed_entities, set()
+            entities = [self._entities[i] for i in entity_ids]
+        if not changed and not entities:
+            return
+        try:
+            self._write(changed, entities)
+        except Exception:
+            # Kept for the next save().
+            with self._lock:
+                self._changed = self._changed or changed
+                self._changed_entities |= entity_ids
+            raise
+
+    def _write(self, changed, entities):
+        with engine.begin() as connection:
+            if changed:
+                connection.execute(session_table.delete().where(
+                    session_table.c.phone_number == self.phone_number
+                ))
+                connection.execute(session_table.insert(), {
+                    'phone_number': self.phone_number,
+                    'dc_id': self._dc_id,
+                    'server_address': self._server_address,
+                    'port': self._port,
+                    'auth_key': self._auth_key.key if self._auth_key else None,
+                    'updated_at': datetime.datetime.now(),
+                })
+            for chunk in chunks(entities):
+                connection.execute(entity_table.delete().where(
+                    (entity_table.c.phone_number == self.phone_number) &
+                    entity_table.c.id.in_([row[0] for row in chunk])
+                ))
+                connection.execute(entity_table.insert(), [
+                    _entity_mapping(self.phone_number, row) for row in chunk
+                ])
+
+    def close(self):
+        self.save()
+
+    def delete(self):
+        # Called by log_out(); anything still buffered is dropped.
+        with self._lock:
+            self._changed = False
+            self._changed_entities = set()
+        _delete_rows(self.phone_number)
+        return True
+
+
+def create_session(phone_number):
+    """The session argument ``client_pool.create_client`` passes to Telethon."""
+    if config.TELETHON_SESSION_STORE == DATABASE:
+        return DatabaseSession(phone_number)
+    return session_path(phone_number)
+
+
+def _delete_rows(phone_number):
+    with engine.begin() as connection:
+        connection.execute(entity_table.delete().where(
+            entity_table.c.phone_number == phone_number
+        ))
+        connection.execute(session_table.delete().where(
+            session_table.c.phone_number == phone_number
+        ))
+
+
+def delete_session(phone_number):
+    """Forgets the login of an account, in both stores.
+
+    Discard the account's pooled clients first: disconnecting a client
+    saves its session again.
+    """
+    path = session_path(phone_number) + EXTENSION
+    if os.path.exists(path):
+        os.remove(path)
+    _delete_rows(phone_number)
+
+
+def read_session_file(path):
+    """The sessions row and the entities of a Telethon ``.session`` file."""
+    connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        session_row = connection.execute(
+            'select dc_id, server_address, port, auth_key from sessions'
+        ).fetchone()
+        entities = connection.execute(
+            'select id, hash, username, phone, name from entities'
+        ).fetchall()
+    finally:
+        connection.close()
+    return session_row, entities
+
+
+def import_session_files(connection, directory=None):
+    """Copies ``.session`` files of accounts not in the database yet.
+
+    The files are left in place. Returns the number of accounts imported.
+    """
+    directory = directory or config.TELETHON_SESSIONS_DIR
+    if not os.path.isdir(directory):
+        return 0
+    stored = {phone_number for phone_number, in connection.execute(
+        select([session_table.c.phone_number])
+    )}
+    imported = 0
+    for path in sorted(glob.glob(os.path.join(directory, '*' + EXTENSION))):
+        phone_number = os.path.basename(path)[:-len(EXTENSION)]
+        if phone_number in stored:
+            continue
+        try:
+            session_row, entities = read_session_file(path)
+        except sqlite3.Error as e:
+            config.logger.warning('Skipping {}: {}'.format(path, e))
+            continue
+        if session_row is None or not session_row[3]:
+            # Never logged in.
+            continue
+        dc_id, server_address, port, auth_key = session_row
+        connection.execute(session_table.insert(), {
+            'phone_number': phone_number, 'dc_id': dc_id,
+            'server_address': server_address, 'port': port,
+            'auth_key': auth_key, 'updated_at': datetime.datetime.now(),
+        })
+        if entities:
+            connection.execute(entity_table.insert(), [
+                _entity_mapping(phone_number, row) for row in entities
+            ])
+        imported += 1
+    return imported
+
+
+if __name__ == '__main__':
+    with engine.begin() as connection:
+        count = import_session_files(connection)
+    config.logger.info('Imported {} session files.'.format(count))
@@ -0,0 +1,133 @@
+"""Tells schedulers about tasks started, stopped, edited or deleted.
+
+Handlers call ``publish`` with the ids of the tasks they changed, after the
+change is committed. A scheduler in the same process gets them on an
+in-process queue. On PostgreSQL they are also sent with NOTIFY, so
+schedulers in other processes hear about them through ``listen``; on SQLite
+those fall back to the periodic resync.
+"""
+import json
+import time
+import queue
+import select
+import threading
+
+from sqlalchemy import text
+
+import config
+from database import engine
+from scheduler import task_scheduler
+
+CHANNEL = 'task_events'
+# NOTIFY payloads are limited to 8000 bytes.
+IDS_PER_NOTIFY = 500
+# Seconds between health checks of an idle listening connection.
+LISTEN_TIMEOUT = 60
+RECONNECT_DELAY = 5
+
+
+class TaskEvents:
+
+    def __init__(self, notify, local):
+        self.notify = notify
+        self.local = local
+        self._queue = queue.Queue()
+        self._resync = threading.Event()
+
+    def publish(self, task_ids, remote_only=False):
+        """Reports changed tasks; call it once the change is committed.
+
+        ``remote_only`` skips this process's own scheduler, which already
+        knows about the change.
+        """
+        task_ids = list(task_ids)
+        if not task_ids:
+            return
+        if self.local and not remote_only:
+            for task_id in task_ids:
+                self._queue.put(task_id)
+            task_scheduler.wake()
+        if self.notify:
+            try:
+                self._notify(task_ids)
+            except Exception as e:
+                # Other schedulers still see the change on their next resync.
+                config.logger.exception(e)
+
+    @staticmethod
+    def _notify(task_ids):
+        with engine.begin() as connection:
+            for i in range(0, len(task_ids), IDS_PER_NOTIFY):
+                payload = json.dumps({'worker': config.WORKER_ID,
+                                      'tasks': task_ids[i:i + IDS_PER_NOTIFY]})
+                connection.execute(text('SELECT pg_notify(:channel, :payload)'),
+                                   channel=CHANNEL, payload=payload)
+
+    def drain(self):
+        """Ids of the tasks changed since the last call."""
+        task_ids = set()
+        while True:
+            try:
+                task_ids.add(self._queue.get_nowait())
+            except queue.Empty:
+                return task_ids
+
+    def resync_needed(self):
+        """Whether events may have been missed since the last call."""
+        if self._resync.is_set():
+            self._resync.clear()
+            return True
+        return False
+
+    def listen(self):
+        if not self.notify:
+            return
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                config.logger.exception(e)
+            time.sleep(RECONNECT_DELAY)
+
+    def _listen(self):
+        # Holds one pooled connection for as long as the scheduler runs.
+        connection = engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN ' + CHANNEL)
+            # Changes made before LISTEN took effect were not heard.
+            self._resync.set()
+            task_scheduler.wake()
+            while True:
+                if select.select([dbapi_connection], [], [], LISTEN_TIMEOUT) == \
+                        ([], [], []):
+                    # Fails if the connection was dropped without notice.
+                    cursor.execute('SELECT 1')
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    self._received(dbapi_connection.notifies.pop(0).payload)
+        except Exception:
+            connection.invalidate()
+            raise
+        finally:
+            connection.close()
+
+    def _received(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            config.logger.warning('Bad task event: {!r}'.format(payload))
+            return
+        if event.get('worker') == config.WORKER_ID:
+            # Published by this process, which has queued it already.
+            return
+        for task_id in event.get('tasks', []):
+            self._queue.put(task_id)
+        task_scheduler.wake()
+
+
+task_events = TaskEvents(notify=engine.dialect.name == 'postgresql',
+                         local=config.RUN_SCHEDULER)
@@ -0,0 +1,75 @@
+import datetime
+
+from sqlalchemy import or_
+
+import config
+from models import Task
+from database import session, engine
+
+
+def lease_is_free(now):
+    return or_(Task.lease_expires_at == None,
+               Task.lease_expires_at < now)
+
+
+def claim_tasks(task_ids):
+    """Lease due tasks to this worker and return the ids it got.
+
+    On PostgreSQL the candidate rows are locked with FOR UPDATE SKIP LOCKED,
+    so concurrent workers split them instead of waiting on each other. SQLite
+    takes a database-wide write lock for the UPDATE, which makes the
+    conditional update itself the compare-and-set.
+    """
+    if not task_ids:
+        return []
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=config.TASK_LEASE_SECONDS)
+
+    if engine.dialect.name == 'postgresql':
+        task_ids = [row.id for row in session.query(Task.id).filter(
+            Task.id.in_(task_ids),
+            Task.active == True,
+            lease_is_free(now)
+        ).with_for_update(skip_locked=True)]
+        if not task_ids:
+            session.commit()
+            return []
+
+    session.query(Task).filter(
+        Task.id.in_(task_ids),
+        Task.active == True,
+        lease_is_free(now)
+    ).update({Task.lease_owner: config.WORKER_ID,
+              Task.lease_expires_at: expires_at},
+             synchronize_session=False)
+    session.commit()
+
+    return [row.id for row in session.query(Task.id).filter(
+        Task.id.in_(task_ids),
+        Task.lease_owner == config.WORKER_ID
+    )]
+
+
+def renew_leases(task_ids):
+    if not task_ids:
+        return
+    expires_at = datetime.datetime.now() + \
+        datetime.timedelta(seconds=config.TASK_LEASE_SECONDS)
+    session.query(Task).filter(
+        Task.id.in_(task_ids),
+        Task.lease_owner == config.WORKER_ID
+    ).update({Task.lease_expires_at: expires_at},
+             synchronize_session=False)
+    session.commit()
+
+
+def release_tasks(task_ids):
+    if not task_ids:
+        return
+    session.query(Task).filter(
+        Task.id.in_(task_ids),
+        Task.lease_owner == config.WORKER_ID
+    ).update({Task.lease_owner: None,
+              Task.lease_expires_at: None},
+             synchronize_session=False)
+    session.commit()
@@ -0,0 +1,125 @@
+import uuid
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import and_, bindparam
+from sqlalchemy.exc import IntegrityError
+
+import config
+from models import TaskRun, TaskRunGroup
+from database import session, engine, chunks
+from buffered_writer import BufferedWriter
+
+SENT = 'sent'
+SKIPPED = 'skipped'
+RETRY = 'retry'
+FAILED = 'failed'
+
+RunState = namedtuple('RunState', 'id started_at groups')
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def load_runs(task_ids):
+    """Unfinished runs of the tasks, as ``{task_id: RunState}``.
+
+    ``RunState.groups`` maps the id of every group attempted so far to its
+    ``(status, attempts)``.
+    """
+    if not task_ids:
+        return {}
+    runs = {}
+    rows = session.query(
+        TaskRun.task_id, TaskRun.id, TaskRun.started_at, TaskRunGroup.group_id,
+        TaskRunGroup.status, TaskRunGroup.attempts
+    ).outerjoin(
+        TaskRunGroup, TaskRunGroup.run_id == TaskRun.id
+    ).filter(
+        TaskRun.task_id.in_(task_ids)
+    )
+    for task_id, run_id, started_at, group_id, status, attempts in rows:
+        run = runs.setdefault(task_id, RunState(run_id, started_at, {}))
+        if group_id is not None and run.id == run_id:
+            run.groups[group_id] = (status, attempts)
+    return runs
+
+
+def start_runs(runs):
+    """Stores new runs, given as ``(run_id, task_id)`` pairs."""
+    if not runs:
+        return
+    now = datetime.datetime.now()
+    session.bulk_insert_mappings(TaskRun, [
+        {'id': run_id, 'task_id': task_id, 'started_at': now}
+        for run_id, task_id in runs
+    ])
+
+
+def finish_runs(run_ids):
+    if not run_ids:
+        return
+    # The foreign key cascades too; this keeps databases without it clean.
+    session.query(TaskRunGroup).filter(
+        TaskRunGroup.run_id.in_(run_ids)
+    ).delete(synchronize_session=False)
+    session.query(TaskRun).filter(
+        TaskRun.id.in_(run_ids)
+    ).delete(synchronize_session=False)
+
+
+class Checkpoints(BufferedWriter):
+    """Buffers per-group progress of running tasks and writes it in batches.
+
+    Rows are written every ``flush_interval`` seconds or once ``batch_size``
+    are waiting. A crash loses at most the progress of the last
+    ``flush_interval`` seconds, which is sent again on resume.
+    """
+
+    def record(self, run_id, group_id, status, attempts=0):
+        self._append({'run_id': run_id, 'group_id': group_id,
+                      'status': status, 'attempts': attempts})
+
+    def _write(self, rows):
+        # A retried group is recorded again; only its last row counts.
+        rows = list({(r['run_id'], r['group_id']): r for r in rows}.values())
+        try:
+            self._replace(rows)
+        except IntegrityError:
+            # Runs of tasks deleted meanwhile are gone; drop their rows.
+            self._replace(self._existing(rows))
+
+    @staticmethod
+    def _replace(rows):
+        # One DELETE by primary key, executed for every row: unlike an IN
+        # list it neither runs into SQLite's limit of bound parameters nor
+        # takes more statements as the buffer grows.
+        if not rows:
+            return
+        table = TaskRunGroup.__table__
+        with engine.begin() as connection:
+            connection.execute(table.delete().where(and_(
+                table.c.run_id == bindparam('old_run_id'),
+                table.c.group_id == bindparam('old_group_id')
+            )), [{'old_run_id': row['run_id'], 'old_group_id': row['group_id']}
+                 for row in rows])
+            connection.execute(table.insert(), rows)
+
+    @staticmethod
+    def _existing(rows):
+        table = TaskRun.__table__
+        run_ids = set()
+        with engine.begin() as connection:
+            for chunk in chunks({row['run_id'] for row in rows}):
+                run_ids.update(run_id for run_id, in connection.execute(
+                    table.select().with_only_columns([table.c.id]).where(
+                        table.c.id.in_(chunk)
+                    )
+                ))
+        return [row for row in rows if row['run_id'] in run_ids]
+
+
+checkpoints = Checkpoints(config.CHECKPOINT_BATCH_SIZE,
+                          config.CHECKPOINT_FLUSH_INTERVAL,
+                          config.CHECKPOINT_MAX_BUFFER)
@@ -1,16 +1,24 @@
 import uuid
 import datetime
-import os
 
-from telethon import TelegramClient
-from telegram import ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import select
+from telegram import (ParseMode, InlineKeyboardButton, InlineKeyboardMarkup,
+                      Update)
 from telegram.ext import (CommandHandler, Updater, MessageHandler,
-                          Filters, CallbackQueryHandler, ConversationHandler)
+                          Filters, CallbackQueryHandler, ConversationHandler,
+                          TypeHandler)
 
 import config
-from models import Token, User, TelegramSession, Task, TelegramGroup
+from models import Token, User, TelegramSession, Task, TelegramGroup, \
+    CachedDialog
 from database import session
-from telegram_svc import restricted, error_callback, build_menu, token_needed
+from telegram_svc import restricted, error_callback, build_menu, token_needed, \
+    remove_session, auth_cache, task_group_ids, add_task_groups, save_task_groups, \
+    ConcurrentConversationHandler, run_in_background, HandlerError, WORKING_TEXT
+from task_events import task_events
+from client_pool import pool, api_credentials
+from session_store import delete_session
+import dialog_cache
 
 updater = Updater(token=config.TELEGRAM_TOKEN)
 dispatcher = updater.dispatcher
@@ -51,6 +59,7 @@ def start(bot, update):
         user = User(tg_id=update.message.chat_id)
         session.add(user)
         session.commit()
+        auth_cache.invalidate(update.message.chat_id)
 
     update.message.reply_text("Hello, @{} "
                               "[<code>{}</code>]".format(update.message.from_user.username,
@@ -112,6 +121,7 @@ def activate_token(bot, update, args):
             ).first()
             user.token = token
             session.commit()
+            auth_cache.invalidate(update.message.chat_id)
             valid_until_f = token.valid_until.strftime('%m.%d.%Y')
             update.message.reply_text("Congratulations! Your token is active "
                                       "until: `{}`".format(valid_until_f),
@@ -133,14 +143,14 @@ def remove_token(bot, update, args):
         ).first()
 
         if token:
-            users_with_token = session.query(User).filter(
-                User.token == token
-            ).all()
-            for u in users_with_token:
-                u.token = None
-            session.commit()
-            session.delete(token)
+            session.query(User).filter(
+                User.token_id == token.id
+            ).update({User.token_id: None}, synchronize_session=False)
+            session.query(Token).filter(
+                Token.id == token.id
+            ).delete(synchronize_session=False)
             session.commit()
+            auth_cache.invalidate()
             update.message.reply_text("Token deleted.",
                                       parse_mode=ParseMode.MARKDOWN)
         else:
@@ -207,30 +217,19 @@ def cancel(bot, update):
 def add_account(bot, update, args, user_data):
     if len(args) == 1:
         phone_number = args[0]
-        user = session.query(User).filter(
-            User.tg_id == update.message.chat_id
-        ).first()
         tg_sessions = session.query(TelegramSession).filter(
-            TelegramSession.user == user
+            TelegramSession.user_id == update.message.chat_id
         ).all()
         phone_numbers = [s.phone_number for s in tg_sessions]
         if phone_number in phone_numbers:
             update.message.reply_text("Sorry, this phone number already exists.")
             return ConversationHandler.END
-        client = TelegramClient(os.path.join(config.TELETHON_SESSIONS_DIR, phone_number),
-                                user.api_id if user.api_id else config.TELEGRAM_API_ID,
-                                user.api_hash if user.api_hash else config.TELEGRAM_API_HASH)
-        client.connect()
-
-        result = client.send_code_request(phone_number, force_sms=True)
-        client.disconnect()
-        tg_session = TelegramSession(phone_number=phone_number,
-                                     phone_code_hash=result.phone_code_hash,
-                                     user=user)
-        session.add(tg_session)
-        session.commit()
-        user_data['session_id'] = tg_session.id
-        update.message.reply_text("Please, send the login code to continue")
+        user_data['session_id'] = None
+        reply = update.message.reply_text(WORKING_TEXT)
+        run_in_background(bot, update.message.chat_id, reply.message_id,
+                          request_login_code, update.message.chat_id,
+                          phone_number, user_data,
+                          conversation=new_tg_account_handler)
 
         return LOGIN_CODE
     else:
@@ -239,6 +238,25 @@ def add_account(bot, update, args, user_data):
         return ConversationHandler.END
 
 
+def _send_code(client, phone_number):
+    return client.send_code_request(phone_number, force_sms=True)
+
+
+def request_login_code(user_id, phone_number, user_data):
+    user = session.query(User).filter(
+        User.tg_id == user_id
+    ).first()
+    result = pool.run(phone_number, *api_credentials(user), _send_code,
+                      phone_number)
+    tg_session = TelegramSession(phone_number=phone_number,
+                                 phone_code_hash=result.phone_code_hash,
+                                 user=user)
+    session.add(tg_session)
+    session.commit()
+    user_data['session_id'] = tg_session.id
+    return {'text': 'Please, send the login code to continue'}
+
+
 def remove_account(bot, update, args):
     if len(args) == 1:
         try:
@@ -246,32 +264,35 @@ def remove_account(bot, update, args):
             user = session.query(User).filter(
                 User.tg_id == update.message.chat_id
             ).first()
-            path = os.path.join(config.TELETHON_SESSIONS_DIR, f'{phone_number}.session')
             tg_session = session.query(TelegramSession).filter(
                 TelegramSession.phone_number == phone_number,
                 TelegramSession.user == user
             ).first()
             if tg_session:
-                tasks = session.query(Task).filter(
-                    Task.session == tg_session
-                ).all()
-                if tasks:
-                    for task in tasks:
-                        groups = session.query(TelegramGroup).filter(
-                            TelegramGroup.task == task
-                        ).all()
-                        if groups:
-                            for group in groups:
-                                session.delete(group)
-                            session.commit()
-                        session.delete(task)
-                    session.commit()
-                session.refresh(tg_session)
-                session.delete(tg_session)
+                # The foreign keys cascade these deletes too; spelling them
+                # out keeps databases created without ON DELETE working.
+                task_ids = [task_id for task_id, in session.query(Task.id).filter(
+                    Task.session_id == tg_session.id
+                )]
+                session.query(TelegramGroup).filter(
+                    TelegramGroup.task_id.in_(
+                        select([Task.id]).where(Task.session_id == tg_session.id)
+                    )
+                ).delete(synchronize_session=False)
+                session.query(Task).filter(
+                    Task.session_id == tg_session.id
+                ).delete(synchronize_session=False)
+                session.query(CachedDialog).filter(
+                    CachedDialog.session_id == tg_session.id
+                ).delete(synchronize_session=False)
+                session.query(TelegramSession).filter(
+                    TelegramSession.id == tg_session.id
+                ).delete(synchronize_session=False)
                 session.commit()
+                task_events.publish(task_ids)
 
-                if os.path.exists(path):
-                    os.remove(path)
+                pool.discard(phone_number)
+                delete_session(phone_number)
 
                 update.message.reply_text("Account deleted.")
             else:
@@ -287,36 +308,43 @@ def remove_account(bot, update, args):
 
 @token_needed
 def confirm_tg_account(bot, update, user_data):
-    code = update.message.text
+    if user_data.get('session_id') is None:
+        update.message.reply_text('The login code was not sent. Please, '
+                                  'try /add_account again.')
+        return ConversationHandler.END
+    reply = update.message.reply_text(WORKING_TEXT)
+    run_in_background(bot, update.message.chat_id, reply.message_id, sign_in,
+                      user_data.pop('session_id'), update.message.chat_id,
+                      update.message.text)
+
+    return ConversationHandler.END
+
+
+def sign_in(tg_session_id, user_id, code):
     tg_session = session.query(TelegramSession).filter(
-        TelegramSession.id == int(user_data['session_id'])
+        TelegramSession.id == tg_session_id
     ).first()
     user = session.query(User).filter(
-        User.tg_id == update.message.chat_id
+        User.tg_id == user_id
     ).first()
-    client = TelegramClient(os.path.join(config.TELETHON_SESSIONS_DIR, tg_session.phone_number),
-                            user.api_id if user.api_id else config.TELEGRAM_API_ID,
-                            user.api_hash if user.api_hash else config.TELEGRAM_API_HASH)
-    client.connect()
+    with pool.client(tg_session.phone_number, *api_credentials(user)) as client:
+        try:
+            client.sign_in(tg_session.phone_number, code,
+                           phone_code_hash=tg_session.phone_code_hash)
+            tg_session.active = True
+            reply = 'Account added successfully.'
+        except Exception as e:
+            reply = 'Error: {}.'.format(e)
+            tg_session.active = False
 
-    try:
-        client.sign_in(tg_session.phone_number, code,
-                       phone_code_hash=tg_session.phone_code_hash)
-        tg_session.active = True
-        update.message.reply_text('Account added successfully.')
-    except Exception as e:
-        update.message.reply_text('Error: {}.'.format(e))
-        path = os.path.join(config.TELETHON_SESSIONS_DIR,
-                            '{}.session'.format(tg_session.phone_number))
-        if os.path.exists(path):
-            os.remove(path)
+    if not tg_session.active:
+        pool.discard(tg_session.phone_number)
+        delete_session(tg_session.phone_number)
         session.delete(tg_session)
 
     session.commit()
 
-    client.disconnect()
-
-    return ConversationHandler.END
+    return {'text': reply}
 
 
 @token_needed
@@ -425,53 +453,20 @@ def interval(bot, update, user_data):
         task.interval = int(value)
         session.commit()
 
-        user = session.query(User).filter(
-            User.tg_id == update.message.chat_id
-        ).first()
-        client = TelegramClient(os.path.join(config.TELETHON_SESSIONS_DIR, task.session.phone_number),
-                                user.api_id if user.api_id else config.TELEGRAM_API_ID,
-                                user.api_hash if user.api_hash else config.TELEGRAM_API_HASH)
-        client.connect()
-        try:
-            dialogs = client.get_dialogs()
-        except Exception as e:
-            update.message.reply_text('Error happened. Can\'t get groups.')
-            session.delete(task)
-            session.commit()
-            config.logger.exception(e)
-            return ConversationHandler.END
-        client.disconnect()
-        groups = [{'id': i.id, 'title': i.title}
-                  for i in dialogs if i.is_group]
-        # groups = [{'id': i, 'title': 'Group ' + str(i)}
-        #           for i in range(20)]
-        user_data['groups'] = groups
-        if groups:
-            buttons = [InlineKeyboardButton(g['title'], callback_data=g['id'])
-                       for g in groups]
-            if len(buttons) > 6:
-                buttons = [buttons[i:i + 6] for i in range(0, len(buttons), 6)]
-                next_page_btn = InlineKeyboardButton('➡️', callback_data='next_page:1')
-                save_all_btn = InlineKeyboardButton('SAVE ALL ️', callback_data='save_all')
-                buttons[0].append(save_all_btn)
-                buttons[0].append(next_page_btn)
-                reply_markup = InlineKeyboardMarkup(build_menu(buttons[0], n_cols=2))
-            else:
-                reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=2))
-            user_data['page'] = 0
-            bot.send_message(chat_id=update.message.chat_id,
-                             text='Please, choose groups by clicking on them or '
-                                  'just press `SAVE ALL` to select all.',
-                             parse_mode=ParseMode.MARKDOWN,
-                             reply_markup=reply_markup,
-                             timeout=30)
+        if not dialog_cache.is_cached(task.session):
+            # The groups have to come from Telegram, which can take a while.
+            reply = update.message.reply_text(WORKING_TEXT)
+            run_in_background(bot, update.message.chat_id, reply.message_id,
+                              load_groups, task.id, user_data,
+                              conversation=start_posting_handler)
             return SELECT_GROUPS
-        else:
-            update.message.reply_text('This account doesn\'t have any groups. '
-                                      'Try using another account via /start_posting')
-            session.delete(task)
-            session.commit()
+        try:
+            reply = load_groups(task.id, user_data)
+        except HandlerError as e:
+            update.message.reply_text(str(e))
             return ConversationHandler.END
+        bot.send_message(chat_id=update.message.chat_id, timeout=30, **reply)
+        return SELECT_GROUPS
     else:
         update.message.reply_text('Oops! Interval has to be integer '
                                   'value (in minutes). Send me another '
@@ -479,11 +474,45 @@ def interval(bot, update, user_data):
         return INTERVAL
 
 
+def load_groups(task_id, user_data):
+    task = session.query(Task).get(task_id)
+    try:
+        groups = dialog_cache.get_groups(task.session)
+    except Exception as e:
+        config.logger.exception(e)
+        session.rollback()
+        session.delete(task)
+        session.commit()
+        raise HandlerError('Error happened. Can\'t get groups.')
+    # groups = [{'id': i, 'title': 'Group ' + str(i)}
+    #           for i in range(20)]
+    if not groups:
+        session.delete(task)
+        session.commit()
+        raise HandlerError('This account doesn\'t have any groups. '
+                           'Try using another account via /start_posting')
+    user_data['groups'] = groups
+    buttons = [InlineKeyboardButton(g['title'], callback_data=g['id'])
+               for g in groups]
+    if len(buttons) > 6:
+        buttons = [buttons[i:i + 6] for i in range(0, len(buttons), 6)]
+        next_page_btn = InlineKeyboardButton('➡️', callback_data='next_page:1')
+        save_all_btn = InlineKeyboardButton('SAVE ALL ️', callback_data='save_all')
+        buttons[0].append(save_all_btn)
+        buttons[0].append(next_page_btn)
+        reply_markup = InlineKeyboardMarkup(build_menu(buttons[0], n_cols=2))
+    else:
+        reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=2))
+    user_data['page'] = 0
+    return {'text': 'Please, choose groups by clicking on them or '
+                    'just press `SAVE ALL` to select all.',
+            'parse_mode': ParseMode.MARKDOWN,
+            'reply_markup': reply_markup}
+
+
 @token_needed
 def select_groups(bot, update, user_data):
-    task = session.query(Task).filter(
-        Task.id == user_data['task_id'],
-    ).first()
+    task_id = user_data['task_id']
 
     query = update.callback_query
 
@@ -495,11 +524,8 @@ def select_groups(bot, update, user_data):
     start_task_markup = InlineKeyboardMarkup(start_task_buttons)
 
     if query.data == 'save_all':
-        for g in user_data['groups']:
-            tg_group = TelegramGroup(title=g['title'],
-                                     tg_id=g['id'],
-                                     task=task)
-            session.add(tg_group)
+        save_task_groups(task_id, user_data['groups'],
+                         {g['id'] for g in user_data['groups']})
         session.commit()
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
@@ -515,10 +541,7 @@ def select_groups(bot, update, user_data):
                               timeout=30)
         return START_TASK
     elif query.data.startswith('next_page') or query.data.startswith('prev_page'):
-        task_groups = session.query(TelegramGroup).filter(
-            TelegramGroup.task == task
-        ).all()
-        task_groups_ids = [g.tg_id for g in task_groups]
+        task_groups_ids = task_group_ids(task_id)
         buttons = [InlineKeyboardButton('✔️ '+g['title'], callback_data=str(g['id'])+'+')
                    if g['id'] in task_groups_ids else
                    InlineKeyboardButton(g['title'], callback_data=g['id'])
@@ -544,7 +567,7 @@ def select_groups(bot, update, user_data):
             buttons[go_to_page].append(next_page_btn)
 
         buttons[go_to_page].append(save_all_btn)
-        if task_groups:
+        if task_groups_ids:
             buttons[go_to_page].append(save_btn)
 
         user_data['page'] = go_to_page
@@ -559,24 +582,17 @@ def select_groups(bot, update, user_data):
         return SELECT_GROUPS
     else:
         if query.data.endswith('+'):
-            tg_group = session.query(TelegramGroup).filter(
-                            TelegramGroup.task == task,
-                            TelegramGroup.tg_id == int(query.data.strip('+'))
-                        ).first()
-            session.delete(tg_group)
+            session.query(TelegramGroup).filter(
+                TelegramGroup.task_id == task_id,
+                TelegramGroup.tg_id == int(query.data.strip('+'))
+            ).delete(synchronize_session=False)
             session.commit()
         else:
-            title = next(i['title'] for i in user_data['groups']
+            group = next(i for i in user_data['groups']
                          if i['id'] == int(query.data))
-            tg_group = TelegramGroup(title=title,
-                                     tg_id=int(query.data),
-                                     task=task)
-            session.add(tg_group)
+            add_task_groups(task_id, [group])
             session.commit()
-        task_groups = session.query(TelegramGroup).filter(
-            TelegramGroup.task == task
-        ).all()
-        task_groups_ids = [g.tg_id for g in task_groups]
+        task_groups_ids = task_group_ids(task_id)
         buttons = [InlineKeyboardButton('✔️ ' + g['title'], callback_data=str(g['id'])+'+')
                    if g['id'] in task_groups_ids else
                    InlineKeyboardButton(g['title'], callback_data=g['id'])
@@ -598,7 +614,7 @@ def select_groups(bot, update, user_data):
 
         buttons[current_page].append(save_all_btn)
 
-        if task_groups:
+        if task_groups_ids:
             buttons[current_page].append(save_btn)
 
         reply_markup = InlineKeyboardMarkup(build_menu(buttons[current_page],
@@ -621,7 +637,9 @@ def start_task(bot, update, user_data):
 
     if int(query.data):
         task.active = True
+        task.schedule_next_run()
         session.commit()
+        task_events.publish([task.id])
         reply = 'Task is active now.'
     else:
         reply = 'Task is disabled.'
@@ -758,7 +776,9 @@ def task_menu(bot, update, user_data):
 
     if query.data == 'start_task':
         task.active = True
+        task.schedule_next_run()
         session.commit()
+        task_events.publish([task.id])
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
                               text='Task activated!',
@@ -768,6 +788,7 @@ def task_menu(bot, update, user_data):
     elif query.data == 'stop_task':
         task.active = False
         session.commit()
+        task_events.publish([task.id])
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
                               text='Task deactivated!',
@@ -790,57 +811,63 @@ def task_menu(bot, update, user_data):
                               timeout=30)
         return EDIT_INTERVAL
     elif query.data == 'edit_groups':
-        user = session.query(User).filter(
-            User.tg_id == query.message.chat_id
-        ).first()
-        client = TelegramClient(os.path.join(config.TELETHON_SESSIONS_DIR, task.session.phone_number),
-                                user.api_id if user.api_id else config.TELEGRAM_API_ID,
-                                user.api_hash if user.api_hash else config.TELEGRAM_API_HASH)
-        client.connect()
-
+        if not dialog_cache.is_cached(task.session):
+            bot.edit_message_text(chat_id=query.message.chat_id,
+                                  message_id=query.message.message_id,
+                                  text=WORKING_TEXT,
+                                  reply_markup=None,
+                                  timeout=30)
+            run_in_background(bot, query.message.chat_id,
+                              query.message.message_id, load_task_groups,
+                              task.id, user_data,
+                              conversation=edit_tasks_handler)
+            return EDIT_GROUPS
         try:
-            dialogs = client.get_dialogs()
-        except Exception as e:
-            update.message.reply_text('Error happened. Can\'t get groups.')
-            config.logger.exception(e)
+            reply = load_task_groups(task.id, user_data)
+        except HandlerError as e:
+            query.message.reply_text(str(e))
             return ConversationHandler.END
-        client.disconnect()
-        groups = [{'id': i.id, 'title': i.title}
-                  for i in dialogs if i.is_group]
-        # groups = [{'id': i, 'title': 'Group ' + str(i)}
-        #           for i in range(20)]
-        user_data['groups'] = groups
-        task_groups = session.query(TelegramGroup).filter(
-            TelegramGroup.task == task
-        ).all()
-        task_groups_ids = [g.tg_id for g in task_groups]
-        buttons = [InlineKeyboardButton('✔️ ' + g['title'],
-                                        callback_data=str(g['id'])+'+edit')
-                   if g['id'] in task_groups_ids else
-                   InlineKeyboardButton(g['title'], callback_data=g['id'])
-                   for g in user_data['groups']]
-        if len(buttons) > 6:
-            buttons = [buttons[i:i + 6] for i in range(0, len(buttons), 6)]
-            next_page_btn = InlineKeyboardButton('➡️',
-                                                 callback_data='edit_groups_next_page:1')
-            save_all_btn = InlineKeyboardButton('SAVE ALL️', callback_data='edit_save_all')
-            save_btn = InlineKeyboardButton('SAVE SELECTED️', callback_data='edit_save')
-            buttons[0].append(save_all_btn)
-            buttons[0].append(save_btn)
-            buttons[0].append(next_page_btn)
-            reply_markup = InlineKeyboardMarkup(build_menu(buttons[0], n_cols=2))
-        else:
-            reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=2))
-        user_data['page'] = 0
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
-                              text='Please, choose groups you want to send '
-                                   'messages to or /cancel',
-                              reply_markup=reply_markup,
-                              timeout=30)
+                              timeout=30,
+                              **reply)
         return EDIT_GROUPS
 
 
+def load_task_groups(task_id, user_data):
+    task = session.query(Task).get(task_id)
+    try:
+        groups = dialog_cache.get_groups(task.session)
+    except Exception as e:
+        config.logger.exception(e)
+        raise HandlerError('Error happened. Can\'t get groups.')
+    # groups = [{'id': i, 'title': 'Group ' + str(i)}
+    #           for i in range(20)]
+    user_data['groups'] = groups
+    task_groups_ids = task_group_ids(task.id)
+    buttons = [InlineKeyboardButton('✔️ ' + g['title'],
+                                    callback_data=str(g['id'])+'+edit')
+               if g['id'] in task_groups_ids else
+               InlineKeyboardButton(g['title'], callback_data=g['id'])
+               for g in user_data['groups']]
+    if len(buttons) > 6:
+        buttons = [buttons[i:i + 6] for i in range(0, len(buttons), 6)]
+        next_page_btn = InlineKeyboardButton('➡️',
+                                             callback_data='edit_groups_next_page:1')
+        save_all_btn = InlineKeyboardButton('SAVE ALL️', callback_data='edit_save_all')
+        save_btn = InlineKeyboardButton('SAVE SELECTED️', callback_data='edit_save')
+        buttons[0].append(save_all_btn)
+        buttons[0].append(save_btn)
+        buttons[0].append(next_page_btn)
+        reply_markup = InlineKeyboardMarkup(build_menu(buttons[0], n_cols=2))
+    else:
+        reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=2))
+    user_data['page'] = 0
+    return {'text': 'Please, choose groups you want to send '
+                    'messages to or /cancel',
+            'reply_markup': reply_markup}
+
+
 def edit_message(bot, update, user_data):
     text = update.message.text
     task = session.query(Task).filter(
@@ -859,7 +886,10 @@ def edit_interval(bot, update, user_data):
             Task.id == user_data['task_id'],
         ).first()
         task.interval = int(value)
+        task.schedule_next_run()
         session.commit()
+        if task.active:
+            task_events.publish([task.id])
         update.message.reply_text('Interval changed.')
     else:
         update.message.reply_text('You entered wrong value.')
@@ -868,9 +898,7 @@ def edit_interval(bot, update, user_data):
 
 
 def edit_groups(bot, update, user_data):
-    task = session.query(Task).filter(
-        Task.id == user_data['task_id'],
-    ).first()
+    task_id = user_data['task_id']
 
     query = update.callback_query
 
@@ -878,19 +906,8 @@ def edit_groups(bot, update, user_data):
     save_btn = InlineKeyboardButton('SAVE SELECTED️', callback_data='edit_save')
 
     if query.data == 'edit_save_all':
-        # delete current groups
-        current_groups = session.query(TelegramGroup).filter(
-            TelegramGroup.task == task
-        ).all()
-        for g in current_groups:
-            session.delete(g)
-        session.commit()
-        # add all
-        for g in user_data['groups']:
-            tg_group = TelegramGroup(title=g['title'],
-                                     tg_id=g['id'],
-                                     task=task)
-            session.add(tg_group)
+        save_task_groups(task_id, user_data['groups'],
+                         {g['id'] for g in user_data['groups']})
         session.commit()
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
@@ -907,10 +924,7 @@ def edit_groups(bot, update, user_data):
         return ConversationHandler.END
     elif query.data.startswith('edit_groups_next_page') or \
             query.data.startswith('edit_groups_prev_page'):
-        task_groups = session.query(TelegramGroup).filter(
-            TelegramGroup.task == task
-        ).all()
-        task_groups_ids = [g.tg_id for g in task_groups]
+        task_groups_ids = task_group_ids(task_id)
         buttons = [InlineKeyboardButton('✔️ ' + g['title'],
                                         callback_data=str(g['id'])+'+edit')
                    if g['id'] in task_groups_ids else
@@ -937,7 +951,7 @@ def edit_groups(bot, update, user_data):
             buttons[go_to_page].append(next_page_btn)
 
         buttons[go_to_page].append(save_all_btn)
-        if task_groups:
+        if task_groups_ids:
             buttons[go_to_page].append(save_btn)
 
         user_data['page'] = go_to_page
@@ -952,24 +966,17 @@ def edit_groups(bot, update, user_data):
         return EDIT_GROUPS
     else:
         if query.data.endswith('+edit'):
-            tg_group = session.query(TelegramGroup).filter(
-                TelegramGroup.task == task,
+            session.query(TelegramGroup).filter(
+                TelegramGroup.task_id == task_id,
                 TelegramGroup.tg_id == int(query.data.strip('+edit'))
-            ).first()
-            session.delete(tg_group)
+            ).delete(synchronize_session=False)
             session.commit()
         else:
-            title = next(i['title'] for i in user_data['groups']
+            group = next(i for i in user_data['groups']
                          if i['id'] == int(query.data))
-            tg_group = TelegramGroup(title=title,
-                                     tg_id=int(query.data),
-                                     task=task)
-            session.add(tg_group)
+            add_task_groups(task_id, [group])
             session.commit()
-        task_groups = session.query(TelegramGroup).filter(
-            TelegramGroup.task == task
-        ).all()
-        task_groups_ids = [g.tg_id for g in task_groups]
+        task_groups_ids = task_group_ids(task_id)
         buttons = [InlineKeyboardButton('✔️ ' + g['title'],
                                         callback_data=str(g['id'])+'+edit')
                    if g['id'] in task_groups_ids else
@@ -992,7 +999,7 @@ def edit_groups(bot, update, user_data):
 
         buttons[current_page].append(save_all_btn)
 
-        if task_groups:
+        if task_groups_ids:
             buttons[current_page].append(save_btn)
 
         reply_markup = InlineKeyboardMarkup(build_menu(buttons[current_page],
@@ -1024,6 +1031,7 @@ def add_admin(bot, update, args):
             if user:
                 user.is_admin = True
                 session.commit()
+                auth_cache.invalidate(tg_id)
                 update.message.reply_text("User [<code>{}</code>] is an "
                                           "admin now.".format(tg_id),
                                           parse_mode=ParseMode.HTML)
@@ -1035,7 +1043,7 @@ def add_admin(bot, update, args):
         update.message.reply_text("Please, send me the user id.")
 
 
-new_tg_account_handler = ConversationHandler(
+new_tg_account_handler = ConcurrentConversationHandler(
     entry_points=[CommandHandler('add_account', add_account,
                                  pass_args=True, pass_user_data=True)],
     states={
@@ -1045,7 +1053,7 @@ new_tg_account_handler = ConversationHandler(
     fallbacks=[CommandHandler('cancel', cancel)]
 )
 
-edit_api_settings_handler = ConversationHandler(
+edit_api_settings_handler = ConcurrentConversationHandler(
     entry_points=[CommandHandler('edit_api', edit_api_settings)],
     states={
         EDIT_API: [MessageHandler(Filters.text, new_api_settings)]
@@ -1053,7 +1061,7 @@ edit_api_settings_handler = ConversationHandler(
     fallbacks=[CommandHandler('cancel', cancel)]
 )
 
-start_posting_handler = ConversationHandler(
+start_posting_handler = ConcurrentConversationHandler(
     entry_points=[CommandHandler('start_posting', start_posting)],
     states={
         SELECT_ACCOUNT: [CallbackQueryHandler(select_account, pass_user_data=True)],
@@ -1065,7 +1073,7 @@ start_posting_handler = ConversationHandler(
     fallbacks=[CommandHandler('cancel', cancel)]
 )
 
-edit_tasks_handler = ConversationHandler(
+edit_tasks_handler = ConcurrentConversationHandler(
     entry_points=[CommandHandler('my_tasks', my_tasks)],
     states={
         SELECT_TASK: [CallbackQueryHandler(select_task, pass_user_data=True)],
@@ -1092,4 +1100,6 @@ dispatcher.add_handler(new_tg_account_handler)
 dispatcher.add_handler(start_posting_handler)
 dispatcher.add_handler(edit_tasks_handler)
 dispatcher.add_handler(edit_api_settings_handler)
+# Runs after the handlers above for every update and ends its unit of work.
+dispatcher.add_handler(TypeHandler(Update, remove_session), group=1)
 dispatcher.add_error_handler(error_callback)
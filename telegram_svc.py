@@ -1,11 +1,17 @@
+import time
 import datetime
+import threading
 from functools import wraps
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+from telegram import Update
 from telegram.error import TelegramError
+from telegram.ext import ConversationHandler
 
 import config
-from models import User
-from database import session
+from models import User, Token, TelegramGroup
+from database import session, chunks
 
 
 def error_callback(bot, update, error):
@@ -15,15 +21,114 @@ def error_callback(bot, update, error):
         config.logger.exception(e)
 
 
+def remove_session(bot, update):
+    session.remove()
+
+
+WORKING_TEXT = 'Working…'
+
+telethon_executor = ThreadPoolExecutor(max_workers=config.TELETHON_WORKERS)
+
+
+class HandlerError(Exception):
+    """Ends the conversation, replying with the exception's message."""
+
+
+def end_conversation(handler, chat_id):
+    # In private chats the conversation key is (chat id, user id).
+    handler.end_conversation((chat_id, chat_id))
+
+
+def run_in_background(bot, chat_id, message_id, func, *args, conversation=None):
+    """Runs ``func(*args)`` on the Telethon executor.
+
+    ``func`` returns the keyword arguments of ``edit_message_text`` for the
+    message ``message_id``, which usually says ``WORKING_TEXT`` until then.
+    If it raises, the message shows the error and ``conversation``, a
+    ``ConcurrentConversationHandler``, is ended before the chat's next update.
+    """
+    telethon_executor.submit(_run_in_background, bot, chat_id, message_id,
+                             func, args, conversation)
+
+
+def _run_in_background(bot, chat_id, message_id, func, args, conversation):
+    failed = True
+    try:
+        reply = func(*args)
+        failed = False
+    except HandlerError as e:
+        reply = {'text': str(e)}
+    except Exception as e:
+        config.logger.exception(e)
+        reply = {'text': 'Error: {}.'.format(e)}
+    finally:
+        session.remove()
+    if failed and conversation is not None:
+        end_conversation(conversation, chat_id)
+    try:
+        bot.edit_message_text(chat_id=chat_id, message_id=message_id,
+                              timeout=30, **reply)
+    except TelegramError as e:
+        config.logger.exception(e)
+
+
+class AuthContext(namedtuple('AuthContext', 'user_id exists is_admin '
+                                             'token_valid_until')):
+
+    @property
+    def has_valid_token(self):
+        return self.token_valid_until is not None and \
+            self.token_valid_until > datetime.date.today()
+
+
+class AuthCache:
+    """Who a Telegram user is, cached for ``ttl`` seconds.
+
+    Handlers that change a user's admin flag or token must call
+    ``invalidate`` so the change is seen by the next update.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+
+        row = session.query(User.is_admin, Token.valid_until).outerjoin(
+            Token, User.token_id == Token.id
+        ).filter(
+            User.tg_id == user_id
+        ).first()
+        if row is None:
+            context = AuthContext(user_id, False, False, None)
+        else:
+            context = AuthContext(user_id, True, bool(row.is_admin), row.valid_until)
+        with self._lock:
+            self._entries[user_id] = (now, context)
+        return context
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+auth_cache = AuthCache(config.AUTH_CACHE_TTL)
+
+
 def restricted(func):
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         user_id = update.effective_user.id
-        admins = session.query(User).filter(
-            User.is_admin == True
-        ).all()
-        admin_ids = [i.tg_id for i in admins]
-        if user_id not in admin_ids:
+        if not auth_cache.get(user_id).is_admin:
             config.logger.warning("Unauthorized access denied "
                                   "for {}.".format(user_id))
             return
@@ -35,14 +140,11 @@ def token_needed(func):
     @wraps(func)
     def wrapped(bot, update, *args, **kwargs):
         user_id = update.effective_user.id
-        user = session.query(User).filter(
-            User.tg_id == user_id
-        ).first()
-        if user.token and user.token.valid_until > datetime.date.today():
+        if auth_cache.get(user_id).has_valid_token:
             return func(bot, update, *args, **kwargs)
         else:
-            update.message.reply_text('Your token is invalid. Please, /activate '
-                                      'a new one.')
+            update.effective_message.reply_text('Your token is invalid. '
+                                                'Please, /activate a new one.')
             config.logger.warning("User {} with invalid token "
                                   "denied.".format(user_id))
             return
@@ -50,6 +152,90 @@ def token_needed(func):
     return wrapped
 
 
+def task_group_ids(task_id):
+    return {tg_id for tg_id, in session.query(TelegramGroup.tg_id).filter(
+        TelegramGroup.task_id == task_id
+    )}
+
+
+def add_task_groups(task_id, groups):
+    if not groups:
+        return
+    session.bulk_insert_mappings(TelegramGroup, [
+        {'title': g['title'], 'tg_id': g['id'], 'task_id': task_id,
+         # Groups listed before an upgrade may lack these.
+         'peer_type': g.get('peer_type'), 'access_hash': g.get('access_hash')}
+        for g in groups
+    ])
+
+
+def save_task_groups(task_id, groups, selected_ids):
+    # Only the difference between what is stored and what is selected is
+    # written: one DELETE per chunk of removed ids and one multi-row INSERT.
+    stored_ids = task_group_ids(task_id)
+    for removed_ids in chunks(stored_ids - selected_ids):
+        session.query(TelegramGroup).filter(
+            TelegramGroup.task_id == task_id,
+            TelegramGroup.tg_id.in_(removed_ids)
+        ).delete(synchronize_session=False)
+    added_ids = selected_ids - stored_ids
+    add_task_groups(task_id, [g for g in groups if g['id'] in added_ids])
+
+
+class ConcurrentConversationHandler(ConversationHandler):
+    """ConversationHandler that may be used by several dispatcher threads.
+
+    python-telegram-bot keeps the conversation picked by ``check_update`` on
+    the handler until ``handle_update`` runs, so two threads could swap each
+    other's state. Here it is kept per thread. Updates of one chat must
+    still be handled in order, which ``webhook.UpdateWorkers`` guarantees.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._routing = threading.local()
+        self._ended = set()
+        self._ended_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def end_conversation(self, key):
+        """Ends a conversation from another thread.
+
+        The handler that started the background work may still be running,
+        and the state it returns would overwrite END. So the conversation is
+        ended when the chat's next update arrives, after that handler has
+        returned.
+        """
+        with self._ended_lock:
+            self._ended.add(key)
+
+    def check_update(self, update):
+        if self._ended and isinstance(update, Update) and \
+                update.effective_chat and update.effective_user:
+            key = self._get_key(update)
+            with self._ended_lock:
+                ended = key in self._ended
+                self._ended.discard(key)
+            if ended:
+                self.update_state(ConversationHandler.END, key)
+        return super().check_update(update)
+
+    @property
+    def current_conversation(self):
+        return getattr(self._routing, 'conversation', None)
+
+    @current_conversation.setter
+    def current_conversation(self, value):
+        self._routing.conversation = value
+
+    @property
+    def current_handler(self):
+        return getattr(self._routing, 'handler', None)
+
+    @current_handler.setter
+    def current_handler(self, value):
+        self._routing.handler = value
+
+
 def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     menu = [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
     if header_buttons:
@@ -1,17 +1,35 @@
 import time
-import os
+import queue
 import threading
 import datetime
+from collections import namedtuple
 
-import schedule
-from telethon import TelegramClient
+from sqlalchemy import bindparam
+from sqlalchemy.orm import joinedload, selectinload
 from telegram import Bot
 
 from models import Token, User, TelegramSession, Task, TelegramGroup
-from database import session
+from database import session, count_queries, chunks
+from scheduler import task_scheduler, next_run_time
+from client_pool import pool, api_credentials
+from posting_engine import PostingEngine
+from rate_limit import limiter
+from task_leases import claim_tasks, renew_leases, release_tasks
+from log_digest import LogDigest
+from delivery_log import delivery_log, SENT, FLOOD_WAIT, FAILED
+import send_errors
+import peers
+import task_runs
+from task_runs import checkpoints
+from task_events import task_events
 import config
+import metrics
 
 bot = Bot(config.TELEGRAM_TOKEN)
+engine = PostingEngine(config.POSTING_WORKERS, config.POSTING_PER_ACCOUNT)
+log_digest = LogDigest(bot, config.LOGS_GROUP_ID,
+                       config.LOGS_DIGEST_WINDOW, config.LOGS_DIGEST_MAX_LINES)
+completed_jobs = queue.Queue()
 
 
 def run_threaded(job_func, args=None):
@@ -23,90 +41,507 @@ def run_threaded(job_func, args=None):
 
 
 def start_schedule():
+    synced_at = None
+    renewed_at = datetime.datetime.now()
+    # Wakes up in time to renew the leases of long runs, whatever the
+    # resync interval, so no other worker takes over a task still running.
+    idle_wait = min(config.SCHEDULER_RESYNC_INTERVAL or float('inf'),
+                    config.TASK_LEASE_SECONDS / 3)
     while True:
         try:
-            schedule.run_pending()
-            time.sleep(1)
+            now = datetime.datetime.now()
+            # Taken first, so events published during a full load are kept.
+            changed_ids = task_events.drain()
+            if synced_at is None or task_events.resync_needed() or \
+                    (config.SCHEDULER_RESYNC_INTERVAL and
+                     (now - synced_at).total_seconds() >=
+                     config.SCHEDULER_RESYNC_INTERVAL):
+                load_schedule()
+                synced_at = now
+            else:
+                reload_tasks(changed_ids)
+            if (now - renewed_at).total_seconds() >= config.TASK_LEASE_SECONDS / 3:
+                renew_leases(task_scheduler.running())
+                renewed_at = now
+            with count_queries() as counter:
+                posting_messages()
+            metrics.tick_queries.set(counter.count)
+            pool.evict_idle()
         except Exception as e:
             config.logger.exception(e)
+            time.sleep(1)
+        finally:
+            session.remove()
+        if completed_jobs.empty():
+            task_scheduler.wait(idle_wait)
 
 
-def send_message_to_group(client, message, group):
-    client.send_message(group.tg_id, message)
+GroupTarget = namedtuple('GroupTarget', 'id tg_id peer_type access_hash')
 
 
-def perform_task(task):
-    groups = session.query(TelegramGroup).filter(
-        TelegramGroup.task == task
-    ).all()
+class PostingJob:
+
+    def __init__(self, task, groups, run_id, new_run=False, attempts=None,
+                 retry_run=False):
+        self.task_id = task.id
+        self.user_id = task.user.tg_id
+        self.phone_number = task.session.phone_number
+        self.api_id, self.api_hash = api_credentials(task.user)
+        self.message = task.message
+        self.groups = [GroupTarget(g.id, g.tg_id, g.peer_type, g.access_hash)
+                       for g in groups]
+        self.run_id = run_id
+        self.new_run = new_run
+        # Set when only failed groups are retried, between regular runs.
+        self.retry_run = retry_run
+        self.attempts = attempts or {}
+        self.finished_run = None
+        self.connected = False
+        self.broken = False
+        self.deferred_until = None
+        self.sent = 0
+        self.skipped = []
+        self.retry = []
+        # New (peer_type, access_hash) of groups, by id, to store.
+        self.peers = {}
 
-    client = TelegramClient(os.path.join(config.TELETHON_SESSIONS_DIR, task.session.phone_number),
-                            task.user.api_id if task.user.api_id else config.TELEGRAM_API_ID,
-                            task.user.api_hash if task.user.api_hash else config.TELEGRAM_API_HASH)
-    client.connect()
+    def defer(self, seconds):
+        self.deferred_until = datetime.datetime.now() + \
+            datetime.timedelta(seconds=seconds)
+
+
+def send_message_to_group(client, job, group):
+    peer = peers.input_peer(group.tg_id, group.peer_type, group.access_hash)
     try:
-        for group in groups:
-            send_message_to_group(client, task.message, group)
+        client.send_message(peer, job.message)
+    except Exception as e:
+        if group.peer_type != peers.CHANNEL or not send_errors.stale_peer(e):
+            raise
+        # The stored access hash was rejected; the session may know a newer
+        # one. Only a different hash is worth another attempt.
+        try:
+            peer = client.get_input_entity(group.tg_id)
+        except ValueError:
+            raise e
+        peer_type, access_hash = peers.describe(peer)
+        if peer_type != peers.CHANNEL or access_hash == group.access_hash:
+            raise
+        client.send_message(peer, job.message)
+        job.peers[group.id] = (peer_type, access_hash)
+        return
+    if group.peer_type is None:
+        # Sent by id, so the session has the peer cached now.
+        try:
+            peer_type, access_hash = peers.describe(
+                client.get_input_entity(group.tg_id))
+        except ValueError:
+            return
+        if peer_type is not None:
+            job.peers[group.id] = (peer_type, access_hash)
+
+
+def record_delivery(job, group, sent_at, started, outcome, error=None):
+    latency = time.monotonic() - started
+    delivery_log.record(job.task_id, group.tg_id, job.phone_number, sent_at,
+                        latency, outcome,
+                        error.__class__.__name__ if error else None)
+    metrics.sends.inc(outcome=outcome)
+    metrics.send_seconds.observe(latency)
+
+
+def send_to_groups(client, job):
+    i = 0
+    flood_waits = 0
+    while i < len(job.groups):
+        group = job.groups[i]
+        limiter.acquire(job.phone_number, group.tg_id)
+        sent_at = datetime.datetime.now()
+        started = time.monotonic()
+        try:
+            send_message_to_group(client, job, group)
+        except Exception as e:
+            kind = send_errors.classify(e)
+            if kind == send_errors.RATE_LIMIT:
+                seconds = send_errors.wait_seconds(e)
+                wait = seconds or config.FLOOD_DEFAULT_WAIT
+                flood_waits += 1
+                record_delivery(job, group, sent_at, started, FLOOD_WAIT, e)
+                config.logger.warning('Account {} has to wait {} seconds before '
+                                      'sending to {}.'.format(job.phone_number,
+                                                              wait, group.tg_id))
+                limiter.pause(job.phone_number, wait)
+                # Without a wait time (PeerFlood) trying again soon only
+                # repeats the error, and a group that keeps hitting short
+                # waits would hold the worker forever.
+                if seconds is None or seconds > config.FLOOD_WAIT_MAX_SLEEP or \
+                        flood_waits > config.FLOOD_WAIT_MAX_RETRIES:
+                    # The groups not reached yet have no checkpoint, so the
+                    # run resumes with them.
+                    job.defer(wait)
+                    return
+                # The next acquire() sleeps through the pause, then the same
+                # group is tried again.
+                continue
+            record_delivery(job, group, sent_at, started, FAILED, e)
+            if kind == send_errors.ACCOUNT:
+                config.logger.exception(e)
+                job.broken = True
+                return
+            config.logger.warning('Sending task {} to {} failed: {!r}'.format(
+                job.task_id, group.tg_id, e
+            ))
+            if kind == send_errors.GROUP:
+                job.skipped.append(group)
+                checkpoints.record(job.run_id, group.id, task_runs.SKIPPED)
+            else:
+                attempts = job.attempts.get(group.id, 0) + 1
+                job.attempts[group.id] = attempts
+                if attempts < config.SEND_RETRY_ATTEMPTS:
+                    job.retry.append(group)
+                    checkpoints.record(job.run_id, group.id, task_runs.RETRY,
+                                       attempts)
+                else:
+                    config.logger.warning('Giving up on group {} of task {} '
+                                          'after {} attempts.'.format(
+                                              group.tg_id, job.task_id, attempts))
+                    checkpoints.record(job.run_id, group.id, task_runs.FAILED,
+                                       attempts)
+            if isinstance(e, ConnectionError):
+                # The message may have gone out, so this group waits for its
+                # retry; the rest of the run gets a new connection.
+                try:
+                    pool.reconnect(client)
+                except Exception as reconnect_error:
+                    config.logger.exception(reconnect_error)
+                    job.defer(config.POSTING_RETRY_DELAY)
+                    return
+        else:
+            record_delivery(job, group, sent_at, started, SENT)
+            limiter.succeeded(job.phone_number)
+            job.sent += 1
+            checkpoints.record(job.run_id, group.id, task_runs.SENT)
+        flood_waits = 0
+        i += 1
+
+
+def due_for_regular_run(task, now):
+    return task.last_message_date is None or \
+        next_run_time(task.id, task.interval, task.last_message_date) <= now
+
+
+def prepare_task(task, now, run):
+    """Builds the job for a due task, resuming its unfinished ``run``."""
+    groups = task.groups
+    if run is not None:
+        # Completing a run's first pass sets last_message_date; after that
+        # only its retries are left.
+        retry_run = task.last_message_date is not None and \
+            task.last_message_date >= run.started_at
+        if not retry_run or not due_for_regular_run(task, now):
+            attempts = {group_id: attempts
+                        for group_id, (status, attempts) in run.groups.items()
+                        if status == task_runs.RETRY}
+            return PostingJob(task, [g for g in groups if g.id not in run.groups or
+                                     g.id in attempts],
+                              run.id, attempts=attempts, retry_run=retry_run)
+    # A regular run sends to every group, including any still awaiting a
+    # retry from the previous run, which is given up on.
+    job = PostingJob(task, groups, task_runs.new_run_id(), new_run=True)
+    if run is not None:
+        job.finished_run = run.id
+    return job
+
+
+def perform_task(job):
+    # Runs on a posting engine worker, so it must not touch the database;
+    # progress goes through the checkpoint buffer.
+    paused_for = limiter.paused_for(job.phone_number)
+    if paused_for > config.FLOOD_WAIT_MAX_SLEEP:
+        job.defer(paused_for)
+        return job
+    try:
+        with pool.client(job.phone_number, job.api_id, job.api_hash) as client:
+            job.connected = True
+            send_to_groups(client, job)
     except Exception as e:
         config.logger.exception(e)
-        bot.send_message(task.user.tg_id,
-                         'It seems like your account {0} is broken. Try '
-                         'to /remove {0} it and /add_account '
-                         '{0} again.'.format(task.session.phone_number))
+        if send_errors.classify(e) == send_errors.ACCOUNT:
+            job.broken = True
+    return job
+
+
+def job_finished(future):
+    completed_jobs.put(future.result())
+    task_scheduler.wake()
+
+
+def complete_task(job, task):
+    """Saves the outcome of a job; returns whether its run is finished."""
+    now = datetime.datetime.now()
+    finished = False
+    if job.broken:
         task.active = False
+        finished = True
+    elif job.deferred_until is not None:
+        # Rate limited: the run resumes with the groups not reached yet.
+        task.next_run_at = job.deferred_until
+    elif not job.connected:
+        task.next_run_at = now + \
+            datetime.timedelta(seconds=config.POSTING_RETRY_DELAY)
+    else:
+        if not job.retry_run:
+            task.last_message_date = now
+        task.schedule_next_run()
+        if job.retry:
+            # Exponential backoff, from the group with the fewest attempts.
+            retry_at = now + datetime.timedelta(
+                seconds=config.SEND_RETRY_DELAY *
+                2 ** (min(job.attempts[g.id] for g in job.retry) - 1)
+            )
+            if retry_at < task.next_run_at:
+                task.next_run_at = retry_at
+        else:
+            finished = True
+    task.lease_owner = task.lease_expires_at = None
+    return finished
+
+
+def store_peers(jobs):
+    peers_by_group = {group_id: peer for job in jobs
+                      for group_id, peer in job.peers.items()}
+    if not peers_by_group:
+        return
+    # Core executemany: groups removed meanwhile just match no row.
+    table = TelegramGroup.__table__
+    session.execute(table.update().where(
+        table.c.id == bindparam('group_id')
+    ).values(
+        peer_type=bindparam('new_peer_type'),
+        access_hash=bindparam('new_access_hash')
+    ), [{'group_id': group_id, 'new_peer_type': peer_type,
+         'new_access_hash': access_hash}
+        for group_id, (peer_type, access_hash) in peers_by_group.items()])
+
+
+def notify_user(user_id, text):
+    # A user who blocked the bot must not stop the tick.
+    try:
+        bot.send_message(chat_id=user_id, text=text)
+    except Exception as e:
+        config.logger.exception(e)
 
-    task.last_message_date = datetime.datetime.now()
-    session.commit()
 
-    client.disconnect()
+def complete_finished_tasks():
+    jobs = []
+    while len(jobs) < config.SCHEDULER_BATCH_SIZE:
+        try:
+            jobs.append(completed_jobs.get_nowait())
+        except queue.Empty:
+            break
+    if not jobs:
+        return
+
+    try:
+        # The runs' progress must be stored before finished runs are removed.
+        checkpoints.flush()
+        tasks = {t.id: t for t in session.query(Task).filter(
+            Task.id.in_([job.task_id for job in jobs])
+        )}
+        finished_runs = [job.run_id for job in jobs
+                         if job.task_id in tasks and
+                         complete_task(job, tasks[job.task_id])]
+        task_runs.finish_runs(finished_runs)
+        store_peers(jobs)
+        # Read before the commit expires the tasks, which would reload each
+        # of them with a query of its own.
+        next_runs = {task.id: task.next_run_at if task.active else None
+                     for task in tasks.values()}
+        session.commit()
+    except Exception as e:
+        config.logger.exception(e)
+        session.rollback()
+        # Before the release, which fails as well if the database is down.
+        for job in jobs:
+            task_scheduler.done(job.task_id)
+        release_tasks([job.task_id for job in jobs])
+        return
+
+    # Other schedulers dropped these tasks when they lost the claim.
+    task_events.publish([job.task_id for job in jobs], remote_only=True)
+    for job in jobs:
+        task_scheduler.done(job.task_id, next_runs.get(job.task_id))
+        if job.task_id not in next_runs:
+            continue
+        if job.broken:
+            notify_user(job.user_id,
+                        'It seems like your account {0} is broken. Try '
+                        'to /remove {0} it and /add_account '
+                        '{0} again.'.format(job.phone_number))
+        if job.connected and not job.broken and job.deferred_until is None:
+            line = 'User [{}] task completed. Message sent to {} of {} ' \
+                   'groups.'.format(job.user_id, job.sent, len(job.groups))
+            if job.skipped:
+                line += ' Skipped {} groups that refused the ' \
+                        'message.'.format(len(job.skipped))
+            if job.retry:
+                line += ' {} groups failed and will be ' \
+                        'retried.'.format(len(job.retry))
+            log_digest.add(line)
+
+
+def _schedule_query():
+    return session.query(
+        Task.id, Task.next_run_at, Task.last_message_date, Task.interval,
+        Task.lease_owner, Task.lease_expires_at
+    )
+
+
+def _deadline(row):
+    task_id, next_run_at, last_message_date, interval, \
+        lease_owner, lease_expires_at = row
+    if next_run_at is None:
+        next_run_at = next_run_time(task_id, interval, last_message_date)
+    if lease_owner not in (None, config.WORKER_ID) and lease_expires_at:
+        # Running on another worker: look again once its lease expires.
+        next_run_at = max(next_run_at, lease_expires_at)
+    return task_id, next_run_at
+
+
+def load_schedule():
+    active_tasks = _schedule_query().filter(
+        Task.active == True
+    ).all()
+    task_scheduler.load([_deadline(row) for row in active_tasks])
+
+
+def reload_tasks(task_ids):
+    """Updates the schedule of tasks reported by ``task_events``."""
+    if not task_ids:
+        return
+    deadlines = {}
+    # Deleting an account publishes all of its tasks at once.
+    for chunk in chunks(task_ids):
+        deadlines.update(_deadline(row) for row in _schedule_query().filter(
+            Task.id.in_(chunk),
+            Task.active == True
+        ))
+    for task_id in task_ids:
+        if task_id in deadlines:
+            task_scheduler.schedule(task_id, deadlines[task_id])
+        else:
+            # Stopped or deleted.
+            task_scheduler.unschedule(task_id)
+
+
+# Statements one posting_messages() call may run, whatever the number of
+# tasks. benchmarks/bench_posting.py checks every tick against it.
+MAX_QUERIES_PER_TICK = 20
+
+
+def deactivate_users(user_ids):
+    if user_ids:
+        session.query(Task).filter(
+            Task.user_id.in_(list(user_ids))
+        ).update({Task.active: False}, synchronize_session=False)
 
 
 def posting_messages():
-    active_tasks = session.query(Task).filter(
-                       Task.active == True
-                   ).all()
-    deactivated_users = []
-    if active_tasks:
-        for task in active_tasks:
-
-            if task.user in deactivated_users:
-                continue
+    complete_finished_tasks()
 
-            token = task.user.token
-
-            if token and token.valid_until >= datetime.date.today():
-                if task.last_message_date != None:
-                    delta = datetime.datetime.now() - task.last_message_date
-                    seconds_passed = delta.total_seconds()
-                    if seconds_passed > task.interval * 60:
-                        perform_task(task)
-                        groups = session.query(TelegramGroup).filter(
-                            TelegramGroup.task == task
-                        ).all()
-                        bot.send_message(config.LOGS_GROUP_ID,
-                                         'User [{}] task completed. Message sent to '
-                                         '{} groups.'.format(task.user.tg_id,
-                                                             len(groups)))
-                    else:
-                        continue
-                else:
-                    perform_task(task)
-                    groups = session.query(TelegramGroup).filter(
-                        TelegramGroup.task == task
-                    ).all()
-                    bot.send_message(config.LOGS_GROUP_ID,
-                                     'User [{}] task completed. Message sent to '
-                                     '{} groups.'.format(task.user.tg_id,
-                                                         len(groups)))
-            else:
-                deactivated_users.append(task.user)
-                session.query(Task).filter(
-                    Task.user == task.user
-                ).update({Task.active: False})
-                session.commit()
-                bot.send_message(chat_id=task.user.tg_id,
-                                 text='Seems like your token is out of date.'
-                                      'All tasks are deactivated.')
-                bot.send_message(config.LOGS_GROUP_ID,
-                                 'User [{}] token is invalid. All tasks '
-                                 'deactivated.'.format(task.user.tg_id))
+    now = datetime.datetime.now()
+    due_ids = task_scheduler.pop_due(now, config.SCHEDULER_BATCH_SIZE)
+    metrics.due_tasks.set(len(due_ids))
+    if not due_ids:
+        return
+
+    submitted_ids = set()
+    try:
+        expired_users = start_due_tasks(due_ids, now, submitted_ids)
+    except Exception:
+        session.rollback()
+        # Otherwise they stay running here for good, and their leases keep
+        # being renewed, so no worker would ever run them again.
+        retry_at = now + datetime.timedelta(seconds=config.POSTING_RETRY_DELAY)
+        unsubmitted_ids = [i for i in due_ids if i not in submitted_ids]
+        for task_id in unsubmitted_ids:
+            task_scheduler.done(task_id, retry_at)
+        try:
+            release_tasks(unsubmitted_ids)
+        except Exception as e:
+            config.logger.exception(e)
+            session.rollback()
+        raise
+
+    for user_id in expired_users:
+        notify_user(user_id, 'Seems like your token is out of date.'
+                             'All tasks are deactivated.')
+        log_digest.add('User [{}] token is invalid. All tasks '
+                       'deactivated.'.format(user_id))
+
+
+def start_due_tasks(due_ids, now, submitted_ids):
+    """Hands the due tasks to the posting engine.
+
+    Adds the ids of the submitted tasks to ``submitted_ids`` as it goes and
+    returns the users whose token expired.
+    """
+    # Tasks leased by another worker are looked at again when the lease
+    # expires, or sooner if that worker publishes their next run time.
+    claimed_ids = claim_tasks(due_ids)
+    due_tasks = session.query(Task).options(
+                    joinedload(Task.user).joinedload(User.token),
+                    joinedload(Task.session),
+                    selectinload(Task.groups)
+                ).filter(
+                    Task.id.in_(claimed_ids),
+                    Task.active == True
+                ).all()
+    for task_id in set(due_ids) - {t.id for t in due_tasks}:
+        task_scheduler.done(task_id)
+    reload_tasks(set(due_ids) - set(claimed_ids))
+
+    runs = task_runs.load_runs([t.id for t in due_tasks])
+    jobs = []
+    released_ids = []
+    expired_users = set()
+    lag = 0
+    for task in due_tasks:
+        if task.next_run_at is not None:
+            lag = max(lag, (now - task.next_run_at).total_seconds())
+
+        if task.user_id in expired_users:
+            released_ids.append(task.id)
+            task_scheduler.done(task.id)
+            continue
+
+        if task.next_run_at is not None and task.next_run_at > now:
+            # Rescheduled since it was pushed, e.g. the interval was edited
+            # or another worker has already run it.
+            released_ids.append(task.id)
+            task_scheduler.done(task.id, task.next_run_at)
+            continue
+
+        token = task.user.token
+
+        if token and token.valid_until >= datetime.date.today():
+            jobs.append(prepare_task(task, now, runs.get(task.id)))
+        else:
+            released_ids.append(task.id)
+            task_scheduler.done(task.id)
+            expired_users.add(task.user_id)
+
+    # The users' other tasks are dropped from the schedule when they come
+    # due and turn out inactive.
+    deactivate_users(expired_users)
+    # Runs are stored before any of their groups can be checkpointed.
+    task_runs.finish_runs([job.finished_run for job in jobs if job.finished_run])
+    task_runs.start_runs([(job.run_id, job.task_id) for job in jobs if job.new_run])
+    session.commit()
+    for job in jobs:
+        engine.submit(job.phone_number, perform_task, job,
+                      callback=job_finished)
+        submitted_ids.add(job.task_id)
+
+    metrics.scheduler_lag.set(lag)
+    release_tasks(released_ids)
+    return expired_users
@@ -0,0 +1,121 @@
+import json
+import queue
+import socketserver
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from telegram import Update
+from telegram.error import TelegramError
+
+import config
+import metrics
+
+
+class UpdateWorkers:
+    """Handles updates on ``workers`` threads.
+
+    Updates are sharded by chat, so the updates of one conversation are
+    always handled in the order they arrived, by the same thread. Each
+    thread has a bounded queue; ``submit`` returns False when it is full.
+    """
+
+    def __init__(self, dispatcher, workers, queue_size):
+        self.dispatcher = dispatcher
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers))
+                        for _ in range(workers)]
+        for update_queue in self._queues:
+            threading.Thread(target=self._work, args=(update_queue,),
+                             daemon=True).start()
+
+    def _shard(self, update):
+        if update.effective_chat is not None:
+            key = update.effective_chat.id
+        elif update.effective_user is not None:
+            key = update.effective_user.id
+        else:
+            key = update.update_id
+        return self._queues[key % len(self._queues)]
+
+    def submit(self, update):
+        try:
+            self._shard(update).put_nowait(update)
+        except queue.Full:
+            metrics.rejected_updates.inc()
+            return False
+        return True
+
+    def queued(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _work(self, update_queue):
+        while True:
+            update = update_queue.get()
+            try:
+                self.dispatcher.process_update(update)
+            except Exception as e:
+                config.logger.exception(e)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Set by start_webhook.
+    webhook_path = None
+    bot = None
+    workers = None
+
+    def do_POST(self):
+        if self.path != self.webhook_path:
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            update = Update.de_json(data, self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            config.logger.warning('Malformed update: {}'.format(e))
+            self.send_error(400)
+            return
+        if not self.workers.submit(update):
+            # Telegram retries the update later.
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_webhook(dispatcher):
+    """Serves the webhook and registers it with Telegram.
+
+    Returns the server, or None if Telegram refused the webhook, in which
+    case the caller should fall back to polling.
+    """
+    bot = dispatcher.bot
+    if config.WEBHOOK_URL:
+        try:
+            bot.set_webhook(url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH)
+        except TelegramError as e:
+            config.logger.exception(e)
+            return None
+    else:
+        config.logger.warning('WEBHOOK_URL is not set, the webhook is not '
+                              'registered with Telegram.')
+
+    workers = UpdateWorkers(dispatcher, config.BOT_WORKERS,
+                            config.UPDATE_QUEUE_SIZE)
+    metrics.queued_updates.callback = workers.queued
+    WebhookHandler.webhook_path = config.WEBHOOK_PATH
+    WebhookHandler.bot = bot
+    WebhookHandler.workers = workers
+    server = WebhookServer((config.WEBHOOK_LISTEN, config.WEBHOOK_PORT),
+                           WebhookHandler)
+    threading.Thread(target=server.serve_forever).start()
+    config.logger.info('Receiving updates on {}:{}'.format(config.WEBHOOK_LISTEN,
+                                                           config.WEBHOOK_PORT))
+    return server